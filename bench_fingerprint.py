@@ -0,0 +1,47 @@
+import random
+import string
+import sys
+import timeit
+
+from fingerprint import ALGORITHMS, NORMALIZERS
+
+# Typical group traffic: short replies, normal chat lines, long pasted announcements
+SIZES = {"short": 24, "chat": 160, "paste": 3000}
+ROUNDS = 20000
+
+def make_messages(size, count=256, ascii_only=False):
+    alphabet = string.ascii_letters + string.digits + " .,!?"
+    if not ascii_only:
+        alphabet += "😀é\u200b"
+    return [''.join(random.choices(alphabet, k=size)) for _ in range(count)]
+
+def bench(func, messages):
+    def run():
+        for text in messages:
+            func(text)
+    seconds = min(timeit.repeat(run, number=ROUNDS // len(messages), repeat=5))
+    return seconds / (ROUNDS // len(messages) * len(messages))
+
+def main():
+    random.seed(0)
+    print(f"{'algorithm':<10} {'size':<6} {'ns/msg':>10} {'MB/s':>10}")
+    for label, size in SIZES.items():
+        messages = [m.encode() for m in make_messages(size)]
+        avg_bytes = sum(len(m) for m in messages) / len(messages)
+        for name, func in ALGORITHMS.items():
+            per_msg = bench(func, messages)
+            print(f"{name:<10} {label:<6} {per_msg * 1e9:>10.0f} {avg_bytes / per_msg / 1e6:>10.1f}")
+
+    # Normalization runs on every message before hashing; ASCII-only text
+    # skips the NFKC and invisible-character passes
+    print()
+    print(f"{'normalizer':<16} {'size':<6} {'text':<8} {'ns/msg':>10}")
+    for label, size in SIZES.items():
+        for charset, messages in (("unicode", make_messages(size)), ("ascii", make_messages(size, ascii_only=True))):
+            for name, func in NORMALIZERS.items():
+                per_msg = bench(func, messages)
+                print(f"{name:<16} {label:<6} {charset:<8} {per_msg * 1e9:>10.0f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
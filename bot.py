@@ -2,13 +2,29 @@ import os
 import sys
 import logging
 import asyncio
-import hashlib
-from datetime import datetime
-from flask import Flask, request, jsonify
-from telegram import Update, Bot
+import math
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from weakref import WeakKeyDictionary
+from datetime import datetime, timedelta
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+from telegram import Update, Bot, MessageEntity
+from telegram.helpers import escape_markdown
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
-import psycopg2
+from psycopg import OperationalError, errors, sql
+from psycopg_pool import AsyncConnectionPool
+from fingerprint import (
+    ALGORITHMS, DEFAULT_ALGORITHM, DEFAULT_NORMALIZER, IMAGE_HASH_AVAILABLE, NORMALIZERS,
+    canonical_url, fingerprint as compute_fingerprint, image_hash, minhash
+)
+from migrations import MESSAGES_PARTITIONING, ensure_partitions, list_partitions, messages_kind, migrate, pending_changes
+from structures import HammingIndex, MinHashIndex, OccurrenceCache, ScalableBloomFilter, SeenUpdates, to_bigint
 
 # 1. Setup Logging
 logging.basicConfig(
@@ -18,129 +34,1426 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 2. Flask Setup
-app = Flask(__name__)
-
-# 3. Load Environment
+# 2. Load Environment
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN', '').strip()
 DATABASE_URL = os.getenv('DATABASE_URL')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 
+# Connection pool tuning (seconds for time values)
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', 1800))
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', 300))
+# Health-check connections on checkout (one extra round trip per checkout)
+DB_POOL_CHECK = os.getenv('DB_POOL_CHECK', 'true').lower() == 'true'
+# Server-side prepared statements for the hot queries; disable behind a
+# transaction-mode PgBouncer, which cannot keep them per connection
+DB_PREPARE = os.getenv('DB_PREPARE', 'true').lower() == 'true'
+
+# Duplicate report: how many of the latest senders are listed after the first one
+REPORT_MAX_SENDERS = int(os.getenv('REPORT_MAX_SENDERS', 10))
+REPORT_TEXT_MAX_CHARS = int(os.getenv('REPORT_TEXT_MAX_CHARS', 1000))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Webhook fast-ack: updates are queued and processed by background workers
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 8))
+UPDATE_DRAIN_TIMEOUT = float(os.getenv('UPDATE_DRAIN_TIMEOUT', 10))
+
+# Redelivered updates are dropped by update_id; the DB table makes this work across replicas
+UPDATE_DEDUP_SIZE = int(os.getenv('UPDATE_DEDUP_SIZE', 10000))
+UPDATE_DEDUP_TTL = float(os.getenv('UPDATE_DEDUP_TTL', 3600))
+UPDATE_DEDUP_DB = os.getenv('UPDATE_DEDUP_DB', 'false').lower() == 'true'
+
+# In-process cache of recently seen fingerprints (entries, seconds)
+OCCURRENCE_CACHE_SIZE = int(os.getenv('OCCURRENCE_CACHE_SIZE', 10000))
+OCCURRENCE_CACHE_TTL = float(os.getenv('OCCURRENCE_CACHE_TTL', 3600))
+
+# Per-chat Bloom filters let first-time messages skip the duplicate lookup.
+# A chat starts with room for BLOOM_CAPACITY distinct messages (about 1.4 KB
+# at 1%) and grows in doubling layers up to BLOOM_MAX_BYTES
+BLOOM_FILTER = os.getenv('BLOOM_FILTER', 'true').lower() == 'true'
+BLOOM_CAPACITY = int(os.getenv('BLOOM_CAPACITY', 1000))
+BLOOM_ERROR_RATE = float(os.getenv('BLOOM_ERROR_RATE', 0.01))
+BLOOM_MAX_BYTES = int(os.getenv('BLOOM_MAX_BYTES', 1 << 20))
+
+# Write-behind: buffer occurrences and flush them every WRITE_BATCH_SIZE rows or
+# WRITE_FLUSH_MS; duplicate decisions then come from memory (single replica only)
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', 'false').lower() == 'true'
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 500))
+WRITE_FLUSH_MS = float(os.getenv('WRITE_FLUSH_MS', 200))
+# Past WRITE_BUFFER_MAX_ROWS buffered rows the webhook answers 503; a batch
+# still failing after WRITE_MAX_ATTEMPTS is split and its bad rows dropped
+WRITE_BUFFER_MAX_ROWS = int(os.getenv('WRITE_BUFFER_MAX_ROWS', 20 * WRITE_BATCH_SIZE))
+WRITE_MAX_ATTEMPTS = int(os.getenv('WRITE_MAX_ATTEMPTS', 5))
+
+# Near-duplicate detection: messages of at least NEAR_DUPLICATE_MIN_WORDS
+# words whose word sets have an estimated Jaccard similarity of at least
+# NEAR_DUPLICATE_MIN_SIMILARITY. With the defaults one replaced word is caught
+# in 93% of 5-word and all 10-word messages, and 0.25% of unrelated 5-word
+# pairs match (simulated on a Zipf vocabulary). Each chat keeps up to
+# NEAR_DUPLICATE_MAX_ENTRIES MinHash signatures in a banded LSH index (per replica)
+NEAR_DUPLICATE = os.getenv('NEAR_DUPLICATE', 'false').lower() == 'true'
+NEAR_DUPLICATE_MIN_SIMILARITY = float(os.getenv('NEAR_DUPLICATE_MIN_SIMILARITY', 0.5))
+NEAR_DUPLICATE_MIN_WORDS = int(os.getenv('NEAR_DUPLICATE_MIN_WORDS', 5))
+NEAR_DUPLICATE_MAX_ENTRIES = int(os.getenv('NEAR_DUPLICATE_MAX_ENTRIES', 20000))
+
+# Media (photos, stickers, documents, ...) is fingerprinted by Telegram's
+# file_unique_id at no download cost. MEDIA_PHASH also downloads thumbnails, at
+# most MEDIA_PHASH_DOWNLOADS at a time, and compares their perceptual hashes
+# (computed in MEDIA_PHASH_WORKERS processes, needs Pillow) within
+# MEDIA_PHASH_MAX_DISTANCE of 64 bits. This runs after the handler, in up to
+# MEDIA_PHASH_PENDING background checks that reply once a match is found
+MEDIA_DUPLICATE = os.getenv('MEDIA_DUPLICATE', 'true').lower() == 'true'
+MEDIA_PHASH = os.getenv('MEDIA_PHASH', 'false').lower() == 'true'
+MEDIA_PHASH_DOWNLOADS = int(os.getenv('MEDIA_PHASH_DOWNLOADS', 4))
+MEDIA_PHASH_WORKERS = int(os.getenv('MEDIA_PHASH_WORKERS', 2))
+MEDIA_PHASH_MAX_DISTANCE = int(os.getenv('MEDIA_PHASH_MAX_DISTANCE', 6))
+MEDIA_PHASH_MAX_BYTES = int(os.getenv('MEDIA_PHASH_MAX_BYTES', 1 << 20))
+MEDIA_PHASH_TIMEOUT = float(os.getenv('MEDIA_PHASH_TIMEOUT', 10))
+MEDIA_PHASH_PENDING = int(os.getenv('MEDIA_PHASH_PENDING', 100))
+
+# Links are also fingerprinted one by one in canonical form (tracking
+# parameters stripped, known mirror hosts merged), up to LINK_MAX_PER_MESSAGE
+# per message, so a reposted link is caught whatever text comes with it
+LINK_DUPLICATE = os.getenv('LINK_DUPLICATE', 'true').lower() == 'true'
+LINK_MAX_PER_MESSAGE = int(os.getenv('LINK_MAX_PER_MESSAGE', 5))
+
+# Only repeats within this many hours count as duplicates (0 = forever);
+# chats can override it with /window
+DUPLICATE_WINDOW_HOURS = float(os.getenv('DUPLICATE_WINDOW_HOURS', 0))
+
+# Retention: rows older than RETENTION_DAYS (0 = keep forever, chats can override
+# with /retention) are purged in small id batches by a background task
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', 0))
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', 3600))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 1000))
+RETENTION_PAUSE_MS = float(os.getenv('RETENTION_PAUSE_MS', 100))
+
+# Where message text is stored: 'inline' on every occurrence row, 'fingerprint'
+# once per distinct message, or 'none'; optionally truncated and compressed
+MESSAGE_TEXT_STORAGE = os.getenv('MESSAGE_TEXT_STORAGE', 'fingerprint').lower()
+MESSAGE_TEXT_MAX_CHARS = int(os.getenv('MESSAGE_TEXT_MAX_CHARS', 0))
+
+# Fingerprint algorithm and text normalizer assigned to chats seen for the first time
+FINGERPRINT_ALGORITHM = os.getenv('FINGERPRINT_ALGORITHM', DEFAULT_ALGORITHM)
+FINGERPRINT_NORMALIZER = os.getenv('FINGERPRINT_NORMALIZER', DEFAULT_NORMALIZER)
+
+# Apply pending schema migrations at startup; set to false when they run as a
+# separate `python migrations.py` step before deploy
+MIGRATE_ON_STARTUP = os.getenv('MIGRATE_ON_STARTUP', 'true').lower() == 'true'
+
 if not BOT_TOKEN:
     raise ValueError("❌ BOT_TOKEN not set!")
+if MESSAGE_TEXT_STORAGE not in ('inline', 'fingerprint', 'none'):
+    raise ValueError(f"❌ MESSAGE_TEXT_STORAGE '{MESSAGE_TEXT_STORAGE}' must be inline, fingerprint or none!")
+if FINGERPRINT_ALGORITHM not in ALGORITHMS:
+    raise ValueError(f"❌ FINGERPRINT_ALGORITHM '{FINGERPRINT_ALGORITHM}' not available!")
+if not 0 < NEAR_DUPLICATE_MIN_SIMILARITY <= 1:
+    raise ValueError("❌ NEAR_DUPLICATE_MIN_SIMILARITY must be above 0 and at most 1!")
+if not 0 <= MEDIA_PHASH_MAX_DISTANCE < 16:
+    raise ValueError("❌ MEDIA_PHASH_MAX_DISTANCE must be between 0 and 15!")
+if MEDIA_PHASH and not IMAGE_HASH_AVAILABLE:
+    raise ValueError("❌ MEDIA_PHASH needs Pillow installed!")
+if LINK_MAX_PER_MESSAGE < 1:
+    raise ValueError("❌ LINK_MAX_PER_MESSAGE must be at least 1!")
+if FINGERPRINT_NORMALIZER not in NORMALIZERS:
+    raise ValueError(f"❌ FINGERPRINT_NORMALIZER '{FINGERPRINT_NORMALIZER}' must be one of {', '.join(NORMALIZERS)}!")
 
-# 4. Telegram Application Setup
+# 3. Telegram Application Setup
 telegram_app = Application.builder().token(BOT_TOKEN).build()
 
-def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
+db_pool = None
+
+async def init_pool():
+    # One pool per process: connections are health-checked on checkout and
+    # recycled after DB_POOL_MAX_LIFETIME so server-side state never goes stale.
+    # Prepared statements live per connection and are recreated after recycling
+    global db_pool
+    db_pool = AsyncConnectionPool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_lifetime=DB_POOL_MAX_LIFETIME,
+        max_idle=DB_POOL_MAX_IDLE,
+        check=AsyncConnectionPool.check_connection if DB_POOL_CHECK else None,
+        # Autocommit: each hot-path statement is its own transaction, so no
+        # extra BEGIN/COMMIT round trips. Without DB_PREPARE nothing is prepared
+        kwargs={"autocommit": True, "prepare_threshold": 5 if DB_PREPARE else None},
+        name="scan-target",
+        open=False,
+    )
+    await db_pool.open()
+    logger.info(f"🔌 DB pool ready (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+
+def get_pool_stats():
+    if db_pool is None:
+        return {}
+    # requests_wait_ms / requests_queued show how long handlers wait for a connection
+    return db_pool.get_stats()
+
+# Statements prepared on each live connection; an execution after the first
+# reuses the server-side statement instead of parsing and planning again
+prepared_queries = WeakKeyDictionary()
+prepared_stats = {"prepared": 0, "reused": 0}
+
+async def execute_prepared(conn, query, params):
+    # Hot-path statements skip parse/plan after their first run on a connection
+    if DB_PREPARE:
+        queries = prepared_queries.setdefault(conn, set())
+        prepared_stats["reused" if query in queries else "prepared"] += 1
+        queries.add(query)
+    return await conn.execute(query, params, prepare=DB_PREPARE)
+
+def plan_scans(plan):
+    # (node type, relation) for every scan node of an EXPLAIN (FORMAT JSON) plan
+    scans = []
+    if "Relation Name" in plan:
+        scans.append((plan["Node Type"], plan["Relation Name"]))
+    for child in plan.get("Plans", []):
+        scans.extend(plan_scans(child))
+    return scans
+
+async def check_index_only(conn):
+    # Confirms the history queries can be served by index-only scans. Scans
+    # that would be cheaper on a small table are disabled for the check
+    params = {"chat_id": 0, "fingerprint": b"", "cutoff": datetime.min, "limit": REPORT_MAX_SENDERS}
+    ok = True
+    async with conn.transaction():
+        await conn.execute("SET LOCAL enable_seqscan = off")
+        await conn.execute("SET LOCAL enable_bitmapscan = off")
+        for name, query in (("recent senders", RECENT_SENDERS_SQL), ("window", WINDOW_SQL)):
+            cursor = await conn.execute("EXPLAIN (FORMAT JSON) " + query, params)
+            (plan,) = await cursor.fetchone()
+            other = [scan for scan in plan_scans(plan[0]["Plan"]) if scan[0] != "Index Only Scan"]
+            if other:
+                ok = False
+                logger.warning(f"⚠️ {name} query is not index-only: {other}")
+    if ok:
+        logger.info("✅ History queries use index-only scans")
+    return ok
 
-def init_db():
+async def init_db():
     try:
-        conn = get_db_connection()
-        conn.autocommit = True
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT,
-                message_hash TEXT,
-                message_text TEXT,
-                user_id BIGINT,
-                timestamp TIMESTAMP,
-                user_name TEXT DEFAULT 'Unknown'
-            )
-        ''')
-        # Migration: Drop old unique constraint if it exists
-        try:
-            cursor.execute('ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_chat_id_message_hash_key')
-        except Exception:
-            pass
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_hash ON messages(chat_id, message_hash)')
-        conn.close()
+        async with db_pool.connection() as conn:
+            if MIGRATE_ON_STARTUP:
+                await migrate(conn)
+            else:
+                changes = await pending_changes(conn)
+                if changes:
+                    logger.error(f"❌ Schema needs migrating, run python migrations.py: {changes}")
+            await check_index_only(conn)
         logger.info("📊 Database initialized")
     except Exception as e:
         logger.error(f"❌ DB Init Error: {e}")
 
-# Call init
-if DATABASE_URL:
-    init_db()
+background_tasks = []
+image_hash_pool = None
 
-# 5. Bot Logic
-async def check_duplicate(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message or not update.message.text:
-        return
+async def warm_filters():
+    try:
+        async with db_pool.connection() as conn:
+            await chat_filters.warm(conn)
+    except Exception as e:
+        logger.error(f"❌ Bloom Warm Error: {e}")
 
-    chat_id = update.message.chat_id
-    text = update.message.text
-    user_id = update.message.from_user.id
-    user_name = update.message.from_user.full_name
-    msg_hash = hashlib.md5(text.encode()).hexdigest()
-    
+async def warm_index(index):
+    # Newest last, so the per-chat limit keeps the most recent fingerprints
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Store current occurrence
-        cursor.execute(
-            "INSERT INTO messages (chat_id, message_hash, message_text, user_id, timestamp, user_name) "
-            "VALUES (%s, %s, %s, %s, %s, %s)",
-            (chat_id, msg_hash, text, user_id, datetime.now(), user_name)
+        async with db_pool.connection() as conn:
+            async with conn.transaction():
+                async with conn.cursor(name=f"{index.column}_warm") as cursor:
+                    await cursor.execute(sql.SQL(
+                        "SELECT chat_id, fingerprint, {column} FROM fingerprints "
+                        "WHERE {column} IS NOT NULL ORDER BY last_seen"
+                    ).format(column=sql.Identifier(index.column)))
+                    async for chat_id, fingerprint, signature in cursor:
+                        index.add(chat_id, index.load(signature), fingerprint)
+        logger.info(f"🧲 {index.column} index warmed for {len(index.chats)} chats")
+    except Exception as e:
+        logger.error(f"❌ {index.column} Warm Error: {e}")
+
+async def startup():
+    global image_hash_pool
+    if DATABASE_URL:
+        await init_pool()
+        await init_db()
+        if BLOOM_FILTER:
+            # Warm in the background; until ready every message takes the full path
+            background_tasks.append(asyncio.create_task(warm_filters()))
+        if NEAR_DUPLICATE:
+            background_tasks.append(asyncio.create_task(warm_index(near_index)))
+        if MEDIA_PHASH:
+            image_hash_pool = ProcessPoolExecutor(MEDIA_PHASH_WORKERS)
+            background_tasks.append(asyncio.create_task(warm_index(image_index)))
+        if WRITE_BEHIND:
+            background_tasks.append(asyncio.create_task(write_buffer.run()))
+        background_tasks.append(asyncio.create_task(retention_loop()))
+        if UPDATE_DEDUP_DB:
+            background_tasks.append(asyncio.create_task(expire_processed_updates_loop()))
+    await telegram_app.initialize()
+
+async def shutdown():
+    for task in background_tasks + list(thumbnail_checks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, *thumbnail_checks, return_exceptions=True)
+    if WRITE_BEHIND:
+        # Nothing accepted before shutdown may be lost
+        try:
+            await write_buffer.flush()
+        except Exception:
+            logger.error(f"❌ Shutdown lost {len(write_buffer.rows)} buffered occurrences")
+    await telegram_app.shutdown()
+    if image_hash_pool is not None:
+        image_hash_pool.shutdown(cancel_futures=True)
+    if db_pool is not None:
+        await db_pool.close()
+
+# 4. Bot Logic
+class CachedOccurrences:
+    # occurrences counts the detection window, total the fingerprint's whole
+    # lifetime as the summary table does
+    def __init__(self, first, recent, occurrences, total=None):
+        self.first = first
+        self.recent = deque(recent, maxlen=max(REPORT_MAX_SENDERS, 1))
+        self.occurrences = occurrences
+        self.total = occurrences if total is None else total
+        self.cached_at = time.monotonic()
+
+    def add(self, user_name, timestamp):
+        self.recent.append((user_name, timestamp))
+        self.occurrences += 1
+        self.total += 1
+
+    def in_window(self, cutoff):
+        # Everything cached is newer than the first sender
+        return self.first[1] >= cutoff
+
+occurrence_cache = OccurrenceCache(OCCURRENCE_CACHE_SIZE, OCCURRENCE_CACHE_TTL)
+
+class ChatFilters:
+    # Until warm() has loaded every chat's fingerprints nothing is "definitely
+    # new"; inserts seen meanwhile are replayed into the freshly built filters.
+    # rebuild() does the same for the one chat it reloads
+    def __init__(self):
+        self.filters = {}
+        self.ready = False
+        self.warming = False
+        self.backlog = []
+        self.rebuilding = {}
+        self.definitely_new = 0
+        self.maybe_seen = 0
+        self.false_positives = 0
+
+    def new_filter(self, distinct=0):
+        return ScalableBloomFilter(max(BLOOM_CAPACITY, 2 * distinct), BLOOM_ERROR_RATE, BLOOM_MAX_BYTES)
+
+    def is_new(self, chat_id, fingerprint):
+        if not self.ready:
+            return False
+        chat_filter = self.filters.get(chat_id)
+        if chat_filter is None or fingerprint not in chat_filter:
+            self.definitely_new += 1
+            return True
+        self.maybe_seen += 1
+        return False
+
+    def add(self, chat_id, fingerprint):
+        if not self.ready:
+            if self.warming:
+                self.backlog.append((chat_id, fingerprint))
+            return
+        if chat_id in self.rebuilding:
+            self.rebuilding[chat_id].append(fingerprint)
+        chat_filter = self.filters.get(chat_id)
+        if chat_filter is None:
+            chat_filter = self.filters[chat_id] = self.new_filter()
+        chat_filter.add(fingerprint)
+
+    async def load(self, conn, chat_id=None):
+        # Counts and scan share one snapshot, so every scanned chat was counted
+        async with conn.transaction():
+            await conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cursor = await conn.execute(
+                "SELECT chat_id, count(*) FROM fingerprints "
+                "WHERE %(chat_id)s::bigint IS NULL OR chat_id = %(chat_id)s GROUP BY chat_id",
+                {"chat_id": chat_id}
+            )
+            built = {row_chat: self.new_filter(distinct) for row_chat, distinct in await cursor.fetchall()}
+            async with conn.cursor(name="bloom_warm") as cursor:
+                await cursor.execute(
+                    "SELECT chat_id, fingerprint FROM fingerprints "
+                    "WHERE %(chat_id)s::bigint IS NULL OR chat_id = %(chat_id)s",
+                    {"chat_id": chat_id}
+                )
+                async for row_chat, fingerprint in cursor:
+                    built[row_chat].add(fingerprint)
+        return built
+
+    async def warm(self, conn):
+        self.warming = True
+        try:
+            self.filters = await self.load(conn)
+            self.ready = True
+            for chat_id, fingerprint in self.backlog:
+                self.add(chat_id, fingerprint)
+        finally:
+            self.warming = False
+            self.backlog = []
+        logger.info(f"🌸 Bloom filters warmed for {len(self.filters)} chats")
+
+    async def rebuild(self, conn, chat_id):
+        # After retention purges rows the old filter still claims them; rebuild it.
+        # The old filter keeps answering until the new one has the adds made meanwhile
+        backlog = self.rebuilding.setdefault(chat_id, [])
+        try:
+            built = await self.load(conn, chat_id)
+        finally:
+            del self.rebuilding[chat_id]
+        if self.ready:
+            chat_filter = built.get(chat_id) or self.new_filter()
+            for fingerprint in backlog:
+                chat_filter.add(fingerprint)
+            self.filters[chat_id] = chat_filter
+
+    def stats(self):
+        return {
+            "enabled": BLOOM_FILTER, "ready": self.ready, "chats": len(self.filters),
+            "bytes": sum(f.bytes for f in self.filters.values()),
+            "definitely_new": self.definitely_new, "maybe_seen": self.maybe_seen,
+            "false_positives": self.false_positives,
+        }
+
+chat_filters = ChatFilters()
+
+near_index = MinHashIndex("minhash", NEAR_DUPLICATE, NEAR_DUPLICATE_MIN_SIMILARITY, NEAR_DUPLICATE_MAX_ENTRIES)
+image_index = HammingIndex("phash", MEDIA_PHASH, MEDIA_PHASH_MAX_DISTANCE, NEAR_DUPLICATE_MAX_ENTRIES)
+chat_settings_cache = {}
+
+async def get_chat_settings(chat_id):
+    # Settings only change through commands or migrations, so each chat is read once per process
+    settings = chat_settings_cache.get(chat_id)
+    if settings is None:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute(
+                "WITH ins AS ("
+                "  INSERT INTO chat_settings (chat_id, fingerprint_algo, normalizer) VALUES (%s, %s, %s) "
+                "  ON CONFLICT (chat_id) DO NOTHING RETURNING fingerprint_algo, normalizer, window_hours, retention_days"
+                ") "
+                "SELECT fingerprint_algo, normalizer, window_hours, retention_days FROM ins "
+                "UNION ALL SELECT fingerprint_algo, normalizer, window_hours, retention_days "
+                "FROM chat_settings WHERE chat_id = %s",
+                (chat_id, FINGERPRINT_ALGORITHM, FINGERPRINT_NORMALIZER, chat_id)
+            )
+            row = await cursor.fetchone()
+            if row is None:
+                # Another transaction inserted the chat concurrently; its row was
+                # not in this statement's snapshot but is committed now
+                cursor = await conn.execute(
+                    "SELECT fingerprint_algo, normalizer, window_hours, retention_days "
+                    "FROM chat_settings WHERE chat_id = %s",
+                    (chat_id,)
+                )
+                row = await cursor.fetchone()
+            algorithm, normalizer, window_hours, retention_days = row
+        settings = {
+            "fingerprint_algo": algorithm,
+            "normalizer": normalizer,
+            "window_hours": DUPLICATE_WINDOW_HOURS if window_hours is None else window_hours,
+            "retention_days": RETENTION_DAYS if retention_days is None else retention_days,
+        }
+        chat_settings_cache[chat_id] = settings
+    return settings
+
+def window_cutoff(settings, now):
+    # datetime.min keeps the range condition, and so the index, in every query
+    if settings["window_hours"] <= 0:
+        return datetime.min
+    return now - timedelta(hours=settings["window_hours"])
+
+def sender_label(position, total):
+    if position == 1:
+        return "Pengirim pertama kali"
+    if position == total:
+        return "Pengirim saat ini"
+    if position == 2:
+        return "pengirim kedua kali"
+    return f"pengirim ke-{position}"
+
+def build_report(text, first, recent, occurrences, similarity=None):
+    # first is (user_name, timestamp) of occurrence #1, recent the latest rows in
+    # ascending order; anything in between is collapsed into a single line
+    # Replies use Markdown, so message text and names (links with "_" in
+    # them, mostly) are escaped
+    if len(text) > REPORT_TEXT_MAX_CHARS:
+        text = text[:REPORT_TEXT_MAX_CHARS] + "…"
+    msg_parts = ["❌**DETEKSI DITEMUKAN**❌", f"Isi pesan : {escape_markdown(text)}"]
+    if similarity is not None:
+        msg_parts.append(f"Kemiripan : {similarity:.0%}")
+    msg_parts.append("")
+    u_name, u_time = first
+    msg_parts.append(f"{escape_markdown(u_name)} : {sender_label(1, occurrences)} {u_time.strftime('%H:%M:%S')}")
+    recent = recent[-(occurrences - 1):]
+    skipped = occurrences - 1 - len(recent)
+    if skipped > 0:
+        msg_parts.append(f"... dan {skipped:,} lainnya")
+    for i, (u_name, u_time) in enumerate(recent):
+        position = occurrences - len(recent) + i + 1
+        msg_parts.append(
+            f"{escape_markdown(u_name)} : {sender_label(position, occurrences)} {u_time.strftime('%H:%M:%S')}"
         )
-        conn.commit()
+    return "\n".join(msg_parts)[:TELEGRAM_MESSAGE_LIMIT]
+
+# Both history queries read only columns of idx_chat_fingerprint_cover
+# (check_index_only runs them through EXPLAIN at startup)
+RECENT_SENDERS_SQL = (
+    "SELECT user_name, timestamp FROM messages "
+    "WHERE chat_id = %(chat_id)s AND fingerprint = %(fingerprint)s AND timestamp >= %(cutoff)s "
+    "ORDER BY timestamp DESC LIMIT %(limit)s"
+)
+
+WINDOW_SQL = (
+    "SELECT count(*), min(timestamp), ("
+    "  SELECT user_name FROM messages "
+    "  WHERE chat_id = %(chat_id)s AND fingerprint = %(fingerprint)s AND timestamp >= %(cutoff)s "
+    "  ORDER BY timestamp ASC LIMIT 1"
+    ") FROM messages "
+    "WHERE chat_id = %(chat_id)s AND fingerprint = %(fingerprint)s AND timestamp >= %(cutoff)s"
+)
+
+async def fetch_recent_senders(conn, chat_id, fingerprint, cutoff):
+    cursor = await execute_prepared(
+        conn, RECENT_SENDERS_SQL,
+        {"chat_id": chat_id, "fingerprint": fingerprint, "cutoff": cutoff, "limit": REPORT_MAX_SENDERS}
+    )
+    return (await cursor.fetchall())[::-1]
+
+async def fetch_window(conn, chat_id, fingerprint, cutoff):
+    # Count and first sender inside the window; both walk only the window's
+    # slice of idx_chat_fingerprint_cover
+    cursor = await execute_prepared(
+        conn, WINDOW_SQL, {"chat_id": chat_id, "fingerprint": fingerprint, "cutoff": cutoff}
+    )
+    occurrences, first_seen, first_name = await cursor.fetchone()
+    return (first_name, first_seen), occurrences
+
+def summary_columns(rows):
+    # One summary per (chat_id, fingerprint) in the batch, as the columns of
+    # the UPSERT: first and last sender, count, text and signature
+    summaries = {}
+    for chat_id, fingerprint, _, _, timestamp, user_name, summary_text, signature in rows:
+        summary = summaries.get((chat_id, fingerprint))
+        if summary is None:
+            summaries[(chat_id, fingerprint)] = [
+                user_name, timestamp, user_name, timestamp, 1, summary_text, signature
+            ]
+        else:
+            summary[2:5] = [user_name, timestamp, summary[4] + 1]
+    return list(zip(*[(*key, *summary) for key, summary in summaries.items()]))
+
+class WriteBuffer:
+    # Collects occurrences and writes them in one transaction: COPY for the
+    # rows, one multi-row UPSERT for the per-fingerprint summaries
+    def __init__(self, batch_size, flush_interval, max_rows, max_attempts):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.max_attempts = max_attempts
+        self.rows = []
+        self.full = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.attempts = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failures = 0
+        self.dead_letters = 0
+        self.last_error = None
+        self.last_flush_ms = 0.0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.full.set()
+
+    def saturated(self):
+        # While the database is unreachable the webhook sheds updates instead
+        # of letting the buffer grow
+        return len(self.rows) >= self.max_rows
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # Already logged and counted; the rows wait for the next round
+                pass
+
+    async def flush(self):
+        # Raises when the rows could not be written, so readers that need
+        # them in the database do not go on with an incomplete view
+        async with self.lock:
+            rows, self.rows = self.rows, []
+            if not rows:
+                return
+            started = time.monotonic()
+            written = len(rows)
+            try:
+                await self.write(rows)
+            except asyncio.CancelledError:
+                self.rows[:0] = rows
+                raise
+            except Exception as e:
+                self.failures += 1
+                self.attempts += 1
+                self.last_error = str(e)
+                logger.error(f"❌ Flush Error (attempt {self.attempts}): {e}")
+                if isinstance(e, OperationalError) or self.attempts < self.max_attempts:
+                    # Keep the rows for the next attempt, ahead of anything newer
+                    self.rows[:0] = rows
+                    raise
+                written = await self.salvage(rows)
+            self.attempts = 0
+            self.flushes += 1
+            self.flushed_rows += written
+            self.last_flush_ms = (time.monotonic() - started) * 1000
+
+    async def salvage(self, rows):
+        # The database is up but keeps refusing the batch: write it in ever
+        # smaller pieces until the rows at fault are isolated, and drop those
+        pending, written = [rows], 0
+        while pending:
+            piece = pending.pop()
+            try:
+                await self.write(piece)
+            except (OperationalError, asyncio.CancelledError):
+                self.rows[:0] = piece + [row for rest in reversed(pending) for row in rest]
+                raise
+            except Exception as e:
+                if len(piece) > 1:
+                    middle = len(piece) // 2
+                    pending += [piece[middle:], piece[:middle]]
+                    continue
+                chat_id, fingerprint, _, user_id, timestamp, *_ = piece[0]
+                self.dead_letters += 1
+                logger.error(
+                    f"❌ Dropped Occurrence: chat={chat_id} fingerprint={fingerprint.hex()} "
+                    f"user={user_id} at={timestamp}: {e}"
+                )
+            else:
+                written += len(piece)
+        return written
+
+    async def write(self, rows):
+        columns = summary_columns(rows)
+
+        async with db_pool.connection() as conn:
+            async with conn.transaction():
+                async with conn.cursor() as cursor:
+                    async with cursor.copy(
+                        "COPY messages (chat_id, fingerprint, message_text, user_id, timestamp, user_name) FROM STDIN"
+                    ) as copy:
+                        for row in rows:
+                            await copy.write_row(row[:6])
+                    await cursor.execute(
+                        "INSERT INTO fingerprints "
+                        "  (chat_id, fingerprint, first_user_name, first_seen, last_user_name, last_seen, occurrences, "
+                        "   message_text, minhash) "
+                        "SELECT * FROM unnest("
+                        "  %s::bigint[], %s::bytea[], %s::text[], %s::timestamp[], %s::text[], %s::timestamp[], %s::bigint[], "
+                        "  %s::text[], %s::bytea[]"
+                        ") "
+                        "ON CONFLICT (chat_id, fingerprint) DO UPDATE SET "
+                        "  last_user_name = EXCLUDED.last_user_name, "
+                        "  last_seen = EXCLUDED.last_seen, "
+                        "  previous_seen = fingerprints.last_seen, "
+                        "  occurrences = fingerprints.occurrences + EXCLUDED.occurrences",
+                        [list(column) for column in columns],
+                        prepare=DB_PREPARE
+                    )
+
+    def stats(self):
+        return {
+            "enabled": WRITE_BEHIND, "buffered": len(self.rows), "capacity": self.max_rows,
+            "flushes": self.flushes, "flushed_rows": self.flushed_rows, "failures": self.failures,
+            "failing_attempts": self.attempts, "last_error": self.last_error, "dead_letters": self.dead_letters,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+write_buffer = WriteBuffer(WRITE_BATCH_SIZE, WRITE_FLUSH_MS / 1000, WRITE_BUFFER_MAX_ROWS, WRITE_MAX_ATTEMPTS)
+
+def stored_texts(text):
+    # (text kept on the occurrence row, text kept once on the fingerprint)
+    if MESSAGE_TEXT_MAX_CHARS > 0:
+        text = text[:MESSAGE_TEXT_MAX_CHARS]
+    if MESSAGE_TEXT_STORAGE == 'inline':
+        return text, None
+    if MESSAGE_TEXT_STORAGE == 'fingerprint':
+        return None, text
+    return None, None
+
+UPSERT_OCCURRENCE_SQL = (
+    "WITH ins AS ("
+    "  INSERT INTO messages (chat_id, fingerprint, message_text, user_id, timestamp, user_name) "
+    "  VALUES (%s, %s, %s, %s, %s, %s) "
+    "  RETURNING chat_id, fingerprint, user_name, timestamp"
+    ") "
+    "INSERT INTO fingerprints "
+    "  (chat_id, fingerprint, first_user_name, first_seen, last_user_name, last_seen, occurrences, message_text, "
+    "   minhash) "
+    "SELECT chat_id, fingerprint, user_name, timestamp, user_name, timestamp, 1, %s, %s FROM ins "
+    "ON CONFLICT (chat_id, fingerprint) DO UPDATE SET "
+    "  last_user_name = EXCLUDED.last_user_name, "
+    "  last_seen = EXCLUDED.last_seen, "
+    "  previous_seen = fingerprints.last_seen, "
+    "  occurrences = fingerprints.occurrences + 1"
+)
+
+UPSERT_OCCURRENCE_RETURNING_SQL = (
+    UPSERT_OCCURRENCE_SQL + " RETURNING first_user_name, first_seen, occurrences, previous_seen"
+)
+
+async def record_occurrence(settings, chat_id, fingerprint, text, user_id, user_name, signature=None):
+    now = datetime.now()
+    row_text, summary_text = stored_texts(text)
+    params = (chat_id, fingerprint, row_text, user_id, now, user_name, summary_text, signature)
+    key = (chat_id, fingerprint)
+    cutoff = window_cutoff(settings, now)
+    if WRITE_BEHIND:
+        return await record_buffered(key, params, cutoff)
+
+    # The chat's filter has never seen this fingerprint: just write it
+    if BLOOM_FILTER and chat_filters.is_new(chat_id, fingerprint):
+        async with db_pool.connection() as conn:
+            await execute_prepared(conn, UPSERT_OCCURRENCE_SQL, params)
+        chat_filters.add(chat_id, fingerprint)
+        entry = CachedOccurrences((user_name, now), [(user_name, now)], 1)
+        occurrence_cache.put(key, entry)
+        return entry
+
+    async with db_pool.connection() as conn:
+        # Store current occurrence and bump the chat's fingerprint counter
+        # in one round trip; the keyed UPSERT is O(1) however popular the message is
+        cursor = await execute_prepared(conn, UPSERT_OCCURRENCE_RETURNING_SQL, params)
+        first_name, first_seen, total, previous_seen = await cursor.fetchone()
+        if BLOOM_FILTER:
+            chat_filters.add(chat_id, fingerprint)
+            chat_filters.false_positives += chat_filters.ready and total == 1
+
+        # Write-through: if the cached entry is exactly one occurrence behind the
+        # database it already holds the history, so no read is needed
+        entry = occurrence_cache.get(key)
+        if entry is not None and entry.total == total - 1 and entry.in_window(cutoff):
+            entry.add(user_name, now)
+            return entry
+        occurrence_cache.stale += entry is not None
+
+        if total == 1 or previous_seen is None or previous_seen < cutoff:
+            # Nothing earlier inside the window: this starts a new run
+            entry = CachedOccurrences((user_name, now), [(user_name, now)], 1, total)
+        elif cutoff == datetime.min:
+            recent = await fetch_recent_senders(conn, chat_id, fingerprint, cutoff)
+            entry = CachedOccurrences((first_name, first_seen), recent, total)
+        else:
+            first, occurrences = await fetch_window(conn, chat_id, fingerprint, cutoff)
+            recent = await fetch_recent_senders(conn, chat_id, fingerprint, cutoff)
+            entry = CachedOccurrences(first, recent, occurrences, total)
+    occurrence_cache.put(key, entry)
+    return entry
+
+async def record_buffered(key, params, cutoff):
+    # Write-behind: the row is only queued, so the decision has to come from
+    # memory; the database is read only when the cache has nothing for the key
+    chat_id, fingerprint, _, _, now, user_name, _, _ = params
+    write_buffer.add(params)
+
+    if BLOOM_FILTER:
+        is_new = chat_filters.is_new(chat_id, fingerprint)
+        chat_filters.add(chat_id, fingerprint)
+        if is_new:
+            entry = CachedOccurrences((user_name, now), [(user_name, now)], 1)
+            occurrence_cache.put(key, entry)
+            return entry
+
+    entry = occurrence_cache.get(key)
+    if entry is not None and entry.in_window(cutoff):
+        entry.add(user_name, now)
+        return entry
+
+    # Flush first so the window includes everything queued for this key; a
+    # failed flush fails the update rather than reporting from partial history
+    await write_buffer.flush()
+    async with db_pool.connection() as conn:
+        first, occurrences = await fetch_window(conn, chat_id, fingerprint, cutoff)
+        if occurrences > 1:
+            entry = CachedOccurrences(first, await fetch_recent_senders(conn, chat_id, fingerprint, cutoff), occurrences)
+        else:
+            entry = CachedOccurrences((user_name, now), [(user_name, now)], 1)
+    occurrence_cache.put(key, entry)
+    return entry
 
-        # Fetch all history
-        cursor.execute(
-            "SELECT user_name, timestamp FROM messages WHERE chat_id = %s AND message_hash = %s ORDER BY timestamp ASC",
-            (chat_id, msg_hash)
+async def fetch_history(settings, chat_id, fingerprint, now):
+    # Window history of another stored fingerprint; read-only, so the cache
+    # keeps its write-through bookkeeping
+    cutoff = window_cutoff(settings, now)
+    entry = occurrence_cache.get((chat_id, fingerprint))
+    if entry is not None and entry.in_window(cutoff):
+        return entry
+    if WRITE_BEHIND:
+        await write_buffer.flush()
+    async with db_pool.connection() as conn:
+        first, occurrences = await fetch_window(conn, chat_id, fingerprint, cutoff)
+        if not occurrences:
+            return None
+        recent = await fetch_recent_senders(conn, chat_id, fingerprint, cutoff)
+    return CachedOccurrences(first, recent, occurrences)
+
+async def near_duplicate_report(index, settings, chat_id, fingerprint, signature, text, sender):
+    # A first-time message close to a stored one is reported as its next occurrence
+    match = index.find(chat_id, signature, exclude=fingerprint)
+    if match is None:
+        return None
+    other, similarity = match
+    history = await fetch_history(settings, chat_id, other, sender[1])
+    if history is None:
+        # Left the window or was purged since it was indexed
+        return None
+    return build_report(
+        text, history.first, list(history.recent) + [sender], history.occurrences + 1,
+        similarity=similarity
+    )
+
+async def occurrence_report(message, settings, fingerprint, text, index=None, signature=None):
+    # Shared by every kind of message: store the occurrence and build a report
+    # when it repeats exactly or, being new, resembles a stored one in index
+    chat_id = message.chat_id
+    user = message.from_user
+    entry = await record_occurrence(settings, chat_id, fingerprint, text, user.id, user.full_name, signature)
+
+    report = None
+    if entry.occurrences > 1:
+        report = build_report(text, entry.first, list(entry.recent), entry.occurrences)
+    elif signature is not None:
+        report = await near_duplicate_report(
+            index, settings, chat_id, fingerprint, signature, text, entry.recent[-1]
+        )
+    if signature is not None:
+        index.add(chat_id, signature, fingerprint)
+    return report
+
+def message_links(message):
+    # Canonical form of every link in the message, in order and without repeats
+    links = []
+    kinds = [MessageEntity.URL, MessageEntity.TEXT_LINK]
+    entities = message.parse_caption_entities(kinds) if message.caption else message.parse_entities(kinds)
+    for entity, text in entities.items():
+        link = canonical_url(entity.url if entity.type == MessageEntity.TEXT_LINK else text)
+        if link and link not in links:
+            links.append(link)
+    return links[:LINK_MAX_PER_MESSAGE]
+
+async def links_report(message, settings):
+    # Each link is its own fingerprint, so a repeated link is one keyed lookup
+    # whatever text surrounds it; the first repeated link is reported
+    report = None
+    for link in message_links(message) if LINK_DUPLICATE else ():
+        fingerprint = compute_fingerprint(f"url:{link}", settings["fingerprint_algo"], "raw")
+        link_report = await occurrence_report(message, settings, fingerprint, f"🔗 {link}")
+        report = report or link_report
+    return report
+
+# (message attribute, label shown as the message text); animations also carry
+# a document, so they come first
+MEDIA_KINDS = (
+    ("photo", "🖼️ Foto"), ("sticker", "🏷️ Stiker"), ("animation", "🎞️ GIF"), ("video", "🎬 Video"),
+    ("video_note", "⏺️ Video bulat"), ("voice", "🎤 Pesan suara"), ("audio", "🎵 Audio"), ("document", "📄 Dokumen"),
+)
+
+MEDIA_FILTER = (
+    filters.PHOTO | filters.Sticker.ALL | filters.ANIMATION | filters.VIDEO | filters.VIDEO_NOTE
+    | filters.VOICE | filters.AUDIO | filters.Document.ALL
+)
+
+media_stats = {"hashed": 0, "skipped": 0, "failures": 0, "shed": 0}
+thumbnail_downloads = asyncio.Semaphore(MEDIA_PHASH_DOWNLOADS)
+thumbnail_checks = set()
+
+def media_attachment(message):
+    # (label, file, thumbnail) of the message's media; a photo is a list of
+    # sizes whose smallest doubles as its thumbnail
+    for attribute, label in MEDIA_KINDS:
+        media = getattr(message, attribute)
+        if not media:
+            continue
+        if attribute == "photo":
+            return label, media[-1], media[0]
+        return label, media, getattr(media, "thumbnail", None)
+    return None
+
+async def download_thumbnail(bot, thumbnail):
+    file = await bot.get_file(thumbnail.file_id)
+    return bytes(await file.download_as_bytearray())
+
+async def thumbnail_signature(bot, chat_id, fingerprint, thumbnail):
+    # Perceptual hash of a new media message's thumbnail, stored with its
+    # fingerprint; None without a small enough thumbnail or when fetching fails
+    if thumbnail is None or (thumbnail.file_size or 0) > MEDIA_PHASH_MAX_BYTES:
+        media_stats["skipped"] += 1
+        return None
+    try:
+        async with thumbnail_downloads:
+            data = await asyncio.wait_for(download_thumbnail(bot, thumbnail), MEDIA_PHASH_TIMEOUT)
+        # Decoding is CPU-bound, so it runs outside the event loop's process
+        signature = await asyncio.get_running_loop().run_in_executor(image_hash_pool, image_hash, data)
+    except Exception as e:
+        media_stats["failures"] += 1
+        logger.warning(f"⚠️ Thumbnail Hash Error: {e}")
+        return None
+    media_stats["hashed"] += 1
+
+    if WRITE_BEHIND:
+        # The fingerprint's row may still be queued
+        await write_buffer.flush()
+    async with db_pool.connection() as conn:
+        await conn.execute(
+            "UPDATE fingerprints SET phash = %s WHERE chat_id = %s AND fingerprint = %s",
+            (to_bigint(signature), chat_id, fingerprint)
         )
-        history = cursor.fetchall()
-        
-        if len(history) > 1:
-            msg_parts = ["❌**DETEKSI DITEMUKAN**❌", f"Isi pesan : {text}", ""]
-            for i, (u_name, u_time) in enumerate(history):
-                time_str = u_time.strftime("%H:%M:%S")
-                if i == 0:
-                    label = "Pengirim pertama kali"
-                elif i == len(history) - 1:
-                    label = "Pengirim saat ini"
-                elif i == 1:
-                    label = "pengirim kedua kali"
-                else:
-                    label = f"pengirim ke-{i+1}"
-                msg_parts.append(f"{u_name} : {label} {time_str}")
-            await update.message.reply_text("\n".join(msg_parts), parse_mode='Markdown')
-        conn.close()
+    return signature
+
+async def thumbnail_check(message, settings, bot, fingerprint, label, thumbnail, sender, reply):
+    # Hashes a new media message's thumbnail after its handler has finished and
+    # replies if it resembles stored media and nothing was reported yet
+    try:
+        signature = await thumbnail_signature(bot, message.chat_id, fingerprint, thumbnail)
+        if signature is None:
+            return
+        report = None
+        if reply:
+            report = await near_duplicate_report(
+                image_index, settings, message.chat_id, fingerprint, signature, label, sender
+            )
+        image_index.add(message.chat_id, signature, fingerprint)
+        if report:
+            await message.reply_text(report, parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"❌ Thumbnail Check Error: {e}")
+
+def start_thumbnail_check(*args):
+    # Bounded, so a burst of media cannot pile up downloads without limit
+    if len(thumbnail_checks) >= MEDIA_PHASH_PENDING:
+        media_stats["shed"] += 1
+        return
+    task = asyncio.create_task(thumbnail_check(*args))
+    thumbnail_checks.add(task)
+    task.add_done_callback(thumbnail_checks.discard)
+
+async def media_report(message, settings):
+    # (report, pending thumbnail check); the check only applies to new media
+    label, file, thumbnail = media_attachment(message)
+    # file_unique_id is the same for every copy of a file, whoever sends it
+    fingerprint = compute_fingerprint(f"file:{file.file_unique_id}", settings["fingerprint_algo"], "raw")
+    report = await occurrence_report(message, settings, fingerprint, label)
+    if report or not MEDIA_PHASH:
+        return report, None
+    return None, (fingerprint, label, thumbnail, (message.from_user.full_name, datetime.now()))
+
+def forward_origin(message):
+    # A channel post keeps its chat and message id however often it is forwarded
+    if message.forward_from_chat and message.forward_from_message_id:
+        return f"fwd:{message.forward_from_chat.id}:{message.forward_from_message_id}"
+    return None
+
+async def check_duplicate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if not message:
+        return
+    # Captions are fingerprinted like text
+    text = message.text or message.caption
+    has_media = MEDIA_DUPLICATE and media_attachment(message) is not None
+    origin = forward_origin(message)
+    if not text and not has_media and not origin:
+        return
+
+    try:
+        settings = await get_chat_settings(message.chat_id)
+        reports = []
+        pending = None
+        if origin:
+            # The same post forwarded again is one keyed lookup; its content is
+            # still fingerprinted below, so copies from other channels or pasted
+            # as plain text are caught too
+            fingerprint = compute_fingerprint(origin, settings["fingerprint_algo"], "raw")
+            label = text or f"↪️ {message.forward_from_chat.title or 'Pesan terusan'}"
+            reports.append(await occurrence_report(message, settings, fingerprint, label))
+        if text:
+            fingerprint = compute_fingerprint(text, settings["fingerprint_algo"], settings["normalizer"])
+            signature = minhash(text, NEAR_DUPLICATE_MIN_WORDS) if NEAR_DUPLICATE else None
+            reports.append(await occurrence_report(message, settings, fingerprint, text, near_index, signature))
+        if has_media:
+            report, pending = await media_report(message, settings)
+            reports.append(report)
+        # Links are recorded even when the whole message already repeats
+        reports.append(await links_report(message, settings))
+        report = next(filter(None, reports), None)
+        if pending:
+            # The thumbnail is still indexed when another report was sent
+            start_thumbnail_check(message, settings, context.bot, *pending, not report)
+        if report:
+            await message.reply_text(report, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"❌ Error: {e}")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("👋 Bot Aktif!")
 
+async def is_chat_admin(update, context):
+    if update.effective_chat.type == "private":
+        return True
+    member = await context.bot.get_chat_member(update.message.chat_id, update.message.from_user.id)
+    return member.status in ("administrator", "creator")
+
+async def set_window(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /window <jam>: only repeats within that many hours count; 0 = selamanya
+    chat_id = update.message.chat_id
+    try:
+        if not await is_chat_admin(update, context):
+            await update.message.reply_text("⛔ Hanya admin yang bisa mengubah jendela deteksi.")
+            return
+        settings = await get_chat_settings(chat_id)
+        if not context.args:
+            await update.message.reply_text(f"⏱️ Jendela deteksi: {settings['window_hours']:g} jam (0 = selamanya)")
+            return
+        hours = float(context.args[0])
+        if not math.isfinite(hours) or hours < 0:
+            raise ValueError(hours)
+        async with db_pool.connection() as conn:
+            await conn.execute("UPDATE chat_settings SET window_hours = %s WHERE chat_id = %s", (hours, chat_id))
+        settings["window_hours"] = hours
+        occurrence_cache.invalidate_chat(chat_id)
+        await update.message.reply_text(f"⏱️ Jendela deteksi diubah ke {hours:g} jam")
+    except ValueError:
+        await update.message.reply_text("❌ Format: /window <jam>")
+    except Exception as e:
+        logger.error(f"❌ Error: {e}")
+
+async def set_retention(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /retention <hari>: riwayat lebih lama dari itu dihapus; 0 = simpan selamanya
+    chat_id = update.message.chat_id
+    try:
+        if not await is_chat_admin(update, context):
+            await update.message.reply_text("⛔ Hanya admin yang bisa mengubah masa simpan.")
+            return
+        settings = await get_chat_settings(chat_id)
+        if not context.args:
+            await update.message.reply_text(f"🗑️ Masa simpan riwayat: {settings['retention_days']} hari (0 = selamanya)")
+            return
+        days = int(context.args[0])
+        if days < 0:
+            raise ValueError(days)
+        async with db_pool.connection() as conn:
+            await conn.execute("UPDATE chat_settings SET retention_days = %s WHERE chat_id = %s", (days, chat_id))
+        settings["retention_days"] = days
+        await update.message.reply_text(f"🗑️ Masa simpan riwayat diubah ke {days} hari")
+    except ValueError:
+        await update.message.reply_text("❌ Format: /retention <hari>")
+    except Exception as e:
+        logger.error(f"❌ Error: {e}")
+
+async def set_normalizer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /normalizer <nama> reset: teks lama tidak cocok lagi dengan fingerprint
+    # baru, jadi riwayat teks mulai dari nol; media, link dan terusan tetap
+    chat_id = update.message.chat_id
+    try:
+        if not await is_chat_admin(update, context):
+            await update.message.reply_text("⛔ Hanya admin yang bisa mengubah normalisasi teks.")
+            return
+        settings = await get_chat_settings(chat_id)
+        if not context.args:
+            await update.message.reply_text(
+                f"🔤 Normalisasi teks: {settings['normalizer']} (pilihan: {', '.join(NORMALIZERS)})"
+            )
+            return
+        normalizer = context.args[0]
+        if normalizer not in NORMALIZERS:
+            raise ValueError(normalizer)
+        if normalizer == settings["normalizer"]:
+            await update.message.reply_text(f"🔤 Normalisasi teks sudah {normalizer}")
+            return
+        if context.args[1:] != ["reset"]:
+            await update.message.reply_text(
+                f"⚠️ Setelah diubah, pesan teks lama tidak terdeteksi lagi sebagai duplikat. "
+                f"Kirim /normalizer {normalizer} reset untuk melanjutkan."
+            )
+            return
+        async with db_pool.connection() as conn:
+            await conn.execute("UPDATE chat_settings SET normalizer = %s WHERE chat_id = %s", (normalizer, chat_id))
+        settings["normalizer"] = normalizer
+        await update.message.reply_text(f"🔤 Normalisasi teks diubah ke {normalizer}")
+    except ValueError:
+        await update.message.reply_text(f"❌ Format: /normalizer <{'|'.join(NORMALIZERS)}> reset")
+    except Exception as e:
+        logger.error(f"❌ Error: {e}")
+
 telegram_app.add_handler(CommandHandler("start", start))
-telegram_app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), check_duplicate))
+telegram_app.add_handler(CommandHandler("window", set_window))
+telegram_app.add_handler(CommandHandler("retention", set_retention))
+telegram_app.add_handler(CommandHandler("normalizer", set_normalizer))
+DUPLICATE_FILTER = (filters.TEXT & (~filters.COMMAND)) | filters.CAPTION | filters.FORWARDED
+if MEDIA_DUPLICATE:
+    DUPLICATE_FILTER |= MEDIA_FILTER
+telegram_app.add_handler(MessageHandler(DUPLICATE_FILTER, check_duplicate))
+
+# 5. Update Queue
+seen_updates = SeenUpdates(UPDATE_DEDUP_SIZE, UPDATE_DEDUP_TTL)
+
+async def claim_update(update_id):
+    # Only one replica gets to insert a given update_id
+    async with db_pool.connection() as conn:
+        cursor = await execute_prepared(
+            conn, "INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING", (update_id,)
+        )
+        return cursor.rowcount == 1
+
+async def expire_processed_updates_loop():
+    # Telegram stops redelivering long before UPDATE_DEDUP_TTL, so older claims
+    # can go; this runs whatever the message retention policy is
+    while True:
+        await asyncio.sleep(UPDATE_DEDUP_TTL)
+        try:
+            async with db_pool.connection() as conn:
+                cursor = await conn.execute(
+                    "DELETE FROM processed_updates WHERE received_at < %s",
+                    (datetime.now() - timedelta(seconds=UPDATE_DEDUP_TTL),)
+                )
+            logger.info(f"🧹 Expired {cursor.rowcount} processed updates")
+        except Exception as e:
+            logger.error(f"❌ Update Dedup Error: {e}")
 
-# 6. Webhook Routes
-@app.route('/', methods=['GET', 'HEAD'])
-def index():
-    return "Bot is running!", 200
+update_queue = None
+update_workers = []
+queue_stats = {"enqueued": 0, "processed": 0, "failed": 0, "rejected": 0, "max_depth": 0}
 
-@app.route(f'/{BOT_TOKEN}', methods=['POST'])
-async def webhook():
-    if request.method == "POST":
+async def update_worker():
+    while True:
+        update = await update_queue.get()
         try:
-            update = Update.de_json(request.get_json(force=True), telegram_app.bot)
-            # Initialize app if needed (Render/Gunicorn compatibility)
-            if not telegram_app._initialized:
-                await telegram_app.initialize()
+            if UPDATE_DEDUP_DB and db_pool is not None and not await claim_update(update.update_id):
+                seen_updates.dropped += 1
+                continue
             await telegram_app.process_update(update)
-            return "OK", 200
+            queue_stats["processed"] += 1
+        except Exception as e:
+            queue_stats["failed"] += 1
+            logger.error(f"❌ Update Error: {e}")
+        finally:
+            update_queue.task_done()
+
+def start_update_workers():
+    global update_queue
+    update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+    for _ in range(UPDATE_WORKERS):
+        update_workers.append(asyncio.create_task(update_worker()))
+    logger.info(f"📬 Update queue ready (size={UPDATE_QUEUE_SIZE}, workers={UPDATE_WORKERS})")
+
+async def stop_update_workers():
+    # Finish what Telegram was already told we accepted, then stop the workers
+    try:
+        await asyncio.wait_for(update_queue.join(), UPDATE_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ Dropping {update_queue.qsize()} queued updates on shutdown")
+    for task in update_workers:
+        task.cancel()
+    await asyncio.gather(*update_workers, return_exceptions=True)
+    update_workers.clear()
+
+def get_queue_stats():
+    if update_queue is None:
+        return {}
+    return {**queue_stats, "depth": update_queue.qsize(), "capacity": UPDATE_QUEUE_SIZE, "workers": len(update_workers)}
+
+# 6. Retention
+retention_stats = {
+    "runs": 0, "purged_rows": 0, "purged_fingerprints": 0, "dropped_partitions": 0,
+    "last_run_rows": 0, "last_run_seconds": 0.0,
+}
+
+# A chat's retention in days; 0 means keep forever
+RETENTION_DAYS_SQL = "COALESCE(cs.retention_days, %(days)s)"
+
+async def purge_chat_batch(conn, chat_id, cutoff, after):
+    # One page of the chat's summaries whose first occurrence has expired and
+    # at most RETENTION_BATCH_SIZE expired rows of those fingerprints. Both
+    # reads are keyed by chat_id, so chats that keep history forever are never
+    # scanned. A full batch may have left rows behind, so the caller repeats the
+    # page: settled summaries whose rows are all gone drop out of it
+    cursor = await conn.execute(
+        "WITH page AS ("
+        "  SELECT fingerprint FROM fingerprints "
+        "  WHERE chat_id = %(chat_id)s AND fingerprint > %(after)s AND first_seen < %(cutoff)s "
+        "  ORDER BY fingerprint LIMIT %(batch)s"
+        "), doomed AS ("
+        "  SELECT id FROM messages WHERE chat_id = %(chat_id)s AND timestamp < %(cutoff)s "
+        "    AND fingerprint IN (SELECT fingerprint FROM page) LIMIT %(batch)s"
+        "), purged AS ("
+        "  DELETE FROM messages WHERE timestamp < %(cutoff)s AND id IN (SELECT id FROM doomed) "
+        "  RETURNING fingerprint"
+        "), counts AS ("
+        "  SELECT fingerprint, count(*) AS purged FROM purged GROUP BY fingerprint"
+        ") "
+        "SELECT (SELECT max(fingerprint) FROM page), (SELECT count(*) FROM doomed), "
+        "       (SELECT array_agg(fingerprint) FROM counts), (SELECT array_agg(purged) FROM counts)",
+        {"chat_id": chat_id, "after": after, "cutoff": cutoff, "batch": RETENTION_BATCH_SIZE}
+    )
+    last, selected, fingerprints, counts = await cursor.fetchone()
+    if fingerprints:
+        await settle_summaries(conn, chat_id, fingerprints, counts)
+    return last, selected >= RETENTION_BATCH_SIZE, sum(counts or [])
+
+async def settle_summaries(conn, chat_id, fingerprints, counts):
+    # Purged rows leave the summary's count and first sender behind; the first
+    # sender becomes the oldest remaining row. Summaries with no rows left are
+    # deleted afterwards by their expired last_seen. Decrementing rather than
+    # recounting keeps concurrent UPSERTs intact
+    await conn.execute(
+        "UPDATE fingerprints f SET occurrences = f.occurrences - p.purged, "
+        "  first_seen = m.timestamp, first_user_name = m.user_name "
+        "FROM unnest(%(fingerprints)s::bytea[], %(counts)s::bigint[]) AS p(fingerprint, purged) "
+        "CROSS JOIN LATERAL ("
+        "  SELECT timestamp, user_name FROM messages "
+        "  WHERE chat_id = %(chat_id)s AND fingerprint = p.fingerprint ORDER BY timestamp LIMIT 1"
+        ") m "
+        "WHERE f.chat_id = %(chat_id)s AND f.fingerprint = p.fingerprint",
+        {"chat_id": chat_id, "fingerprints": fingerprints, "counts": counts}
+    )
+
+async def drop_expired_partitions(conn, now):
+    # A partition can go as a whole once even the longest policy has expired it
+    cursor = await conn.execute(
+        "SELECT max(COALESCE(retention_days, %(days)s)), bool_or(COALESCE(retention_days, %(days)s) = 0) "
+        "FROM chat_settings",
+        {"days": RETENTION_DAYS}
+    )
+    longest, keeps_forever = await cursor.fetchone()
+    longest = longest if longest is not None else RETENTION_DAYS
+    if keeps_forever or not longest:
+        return 0, 0, set()
+    cutoff = now - timedelta(days=longest)
+    for name, upper in await list_partitions(conn):
+        if upper is not None and upper <= cutoff:
+            await detach_partition(conn, name)
+
+    # Includes partitions detached by an earlier, interrupted run
+    cursor = await conn.execute(
+        "SELECT relname FROM pg_class WHERE relkind = 'r' AND NOT relispartition "
+        "AND relnamespace = current_schema()::regnamespace "
+        "AND (relname ~ '^messages_p[0-9]{8}$' OR relname = 'messages_legacy')"
+    )
+    dropped, rows, chats = 0, 0, set()
+    for (name,) in await cursor.fetchall():
+        table_rows, table_chats = await settle_detached(conn, name)
+        await conn.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+        logger.info(f"🗑️ Dropped partition {name}")
+        dropped += 1
+        rows += table_rows
+        chats |= table_chats
+    return dropped, rows, chats
+
+async def detach_partition(conn, name):
+    # CONCURRENTLY (PostgreSQL 14+) never holds an exclusive lock on messages
+    statement = sql.SQL("ALTER TABLE messages DETACH PARTITION {} CONCURRENTLY").format(sql.Identifier(name))
+    try:
+        await conn.execute(statement)
+    except errors.ObjectNotInPrerequisiteState:
+        # An earlier concurrent detach was interrupted
+        await conn.execute(sql.SQL("ALTER TABLE messages DETACH PARTITION {} FINALIZE").format(sql.Identifier(name)))
+    except errors.SyntaxError:
+        await conn.execute(sql.SQL("ALTER TABLE messages DETACH PARTITION {}").format(sql.Identifier(name)))
+
+async def settle_detached(conn, name):
+    # The detached table's rows are handed to the summaries chat by chat in
+    # short transactions, each deleting what it settled, so an interrupted run
+    # resumes without counting anything twice. Nothing here touches messages
+    table = sql.Identifier(name)
+    cursor = await conn.execute(sql.SQL("SELECT DISTINCT chat_id FROM {}").format(table))
+    chat_ids = [chat_id for (chat_id,) in await cursor.fetchall()]
+    rows, chats = 0, set()
+    for chat_id in chat_ids:
+        while True:
+            async with conn.transaction():
+                cursor = await conn.execute(sql.SQL(
+                    "WITH purged AS ("
+                    "  DELETE FROM {table} WHERE ctid = ANY(ARRAY("
+                    "    SELECT ctid FROM {table} WHERE chat_id = %(chat_id)s LIMIT %(batch)s"
+                    "  )) RETURNING fingerprint"
+                    "), counts AS ("
+                    "  SELECT fingerprint, count(*) AS purged FROM purged "
+                    "  WHERE fingerprint IS NOT NULL GROUP BY fingerprint"
+                    ") "
+                    "SELECT (SELECT count(*) FROM purged), "
+                    "       (SELECT array_agg(fingerprint) FROM counts), (SELECT array_agg(purged) FROM counts)"
+                ).format(table=table), {"chat_id": chat_id, "batch": RETENTION_BATCH_SIZE})
+                deleted, fingerprints, counts = await cursor.fetchone()
+                if fingerprints:
+                    await settle_summaries(conn, chat_id, fingerprints, counts)
+            rows += deleted
+            if fingerprints:
+                chats.add(chat_id)
+            if deleted < RETENTION_BATCH_SIZE:
+                break
+            await asyncio.sleep(RETENTION_PAUSE_MS / 1000)
+    return rows, chats
+
+async def purge_expired():
+    now = datetime.now()
+    async with db_pool.connection() as conn:
+        cursor = await conn.execute(
+            f"SELECT cs.chat_id, {RETENTION_DAYS_SQL} FROM chat_settings cs WHERE {RETENTION_DAYS_SQL} > 0",
+            {"days": RETENTION_DAYS}
+        )
+        policies = await cursor.fetchall()
+        if not policies:
+            return 0
+        started = time.monotonic()
+        dropped, purged, chats = await drop_expired_partitions(conn, now)
+
+    for chat_id, days in policies:
+        cutoff = now - timedelta(days=days)
+        after = b""
+        while True:
+            # Stay out of the way of the live handler
+            while update_queue is not None and update_queue.qsize() > 0:
+                await asyncio.sleep(RETENTION_PAUSE_MS / 1000)
+            async with db_pool.connection() as conn:
+                last, full, batch_purged = await purge_chat_batch(conn, chat_id, cutoff, after)
+            purged += batch_purged
+            if batch_purged:
+                chats.add(chat_id)
+            if last is None:
+                break
+            if not full:
+                after = last
+            await asyncio.sleep(RETENTION_PAUSE_MS / 1000)
+
+    async with db_pool.connection() as conn:
+        # Summaries whose every row is gone, in the chats that lost rows
+        cursor = await conn.execute(
+            "DELETE FROM fingerprints f USING chat_settings cs "
+            "WHERE f.chat_id = ANY(%(chats)s) AND cs.chat_id = f.chat_id "
+            f"  AND {RETENTION_DAYS_SQL} > 0 AND f.last_seen < %(now)s - make_interval(days => {RETENTION_DAYS_SQL}) "
+            "RETURNING f.chat_id, f.fingerprint",
+            {"chats": list(chats), "now": now, "days": RETENTION_DAYS}
+        )
+        purged_fingerprints = await cursor.fetchall()
+        for chat_id, fingerprint in purged_fingerprints:
+            near_index.remove(chat_id, fingerprint)
+            image_index.remove(chat_id, fingerprint)
+        # Purged fingerprints would otherwise stay "maybe seen" forever
+        for chat_id in chats | {chat_id for chat_id, _ in purged_fingerprints}:
+            occurrence_cache.invalidate_chat(chat_id)
+            if BLOOM_FILTER:
+                await chat_filters.rebuild(conn, chat_id)
+
+    elapsed = time.monotonic() - started
+    retention_stats["runs"] += 1
+    retention_stats["purged_rows"] += purged
+    retention_stats["purged_fingerprints"] += len(purged_fingerprints)
+    retention_stats["dropped_partitions"] += dropped
+    retention_stats["last_run_rows"] = purged
+    retention_stats["last_run_seconds"] = elapsed
+    logger.info(
+        f"🗑️ Retention purged {purged} rows, {len(purged_fingerprints)} fingerprints, "
+        f"{dropped} partitions in {elapsed:.1f}s"
+    )
+    return purged
+
+async def retention_loop():
+    while True:
+        try:
+            if MESSAGES_PARTITIONING != 'none':
+                # Until the table is migrated (MIGRATE_ON_STARTUP=false) it has no partitions
+                async with db_pool.connection() as conn:
+                    if await messages_kind(conn) == 'p':
+                        await ensure_partitions(conn)
+            await purge_expired()
         except Exception as e:
-            logger.error(f"❌ Webhook Error: {e}")
-            return "Error", 500
-    return "Invalid", 400
+            logger.error(f"❌ Retention Error: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+# 7. Webhook Routes
+async def index(request):
+    return PlainTextResponse("Bot is running!", status_code=200)
+
+async def stats(request):
+    return JSONResponse({
+        "db_pool": get_pool_stats(),
+        "update_queue": get_queue_stats(),
+        "seen_updates": seen_updates.stats(),
+        "occurrence_cache": occurrence_cache.stats(),
+        "bloom_filters": chat_filters.stats(),
+        "write_buffer": write_buffer.stats(),
+        "near_duplicates": near_index.stats(),
+        "media": dict(media_stats, enabled=MEDIA_DUPLICATE, pending=len(thumbnail_checks), phash=image_index.stats()),
+        "retention": retention_stats,
+        "prepared_statements": dict(prepared_stats, enabled=DB_PREPARE),
+    }, status_code=200)
+
+async def webhook(request):
+    try:
+        update = Update.de_json(await request.json(), telegram_app.bot)
+    except Exception as e:
+        logger.error(f"❌ Webhook Error: {e}")
+        return PlainTextResponse("Invalid", status_code=400)
+
+    # Telegram redelivers when we were slow or failed; answer OK without reprocessing
+    if not seen_updates.add(update.update_id):
+        return PlainTextResponse("OK", status_code=200)
+
+    # Acknowledge as soon as the update is queued; when the queue or the
+    # write buffer is full, 503 makes Telegram back off and redeliver later
+    if WRITE_BEHIND and write_buffer.saturated():
+        seen_updates.discard(update.update_id)
+        queue_stats["rejected"] += 1
+        logger.warning("⚠️ Write buffer full, rejecting update")
+        return PlainTextResponse("Busy", status_code=503)
+    try:
+        update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        # Not accepted, so the redelivery must not be treated as a duplicate
+        seen_updates.discard(update.update_id)
+        queue_stats["rejected"] += 1
+        logger.warning("⚠️ Update queue full, rejecting update")
+        return PlainTextResponse("Busy", status_code=503)
+    queue_stats["enqueued"] += 1
+    queue_stats["max_depth"] = max(queue_stats["max_depth"], update_queue.qsize())
+    return PlainTextResponse("OK", status_code=200)
+
+@asynccontextmanager
+async def lifespan(app):
+    # One event loop for the whole process: the bot, its HTTP client and the
+    # DB pool are initialized once here and shared by every request
+    await startup()
+    start_update_workers()
+    yield
+    await stop_update_workers()
+    await shutdown()
+
+app = Starlette(
+    routes=[
+        Route('/', index, methods=['GET', 'HEAD']),
+        Route('/stats', stats, methods=['GET']),
+        Route(f'/{BOT_TOKEN}', webhook, methods=['POST']),
+    ],
+    lifespan=lifespan,
+)
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 7860))
-    app.run(host='0.0.0.0', port=port)
+    uvicorn.run(app, host='0.0.0.0', port=port)
@@ -0,0 +1,221 @@
+import hashlib
+import io
+import re
+import struct
+import unicodedata
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+IMAGE_HASH_AVAILABLE = Image is not None
+
+# Dedupe only needs a stable, well-distributed key, not a cryptographic one.
+# Each algorithm returns raw digest bytes, stored as-is in BYTEA columns.
+
+def _md5(data):
+    return hashlib.md5(data).digest()
+
+def _blake2b(data):
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+def _xxh3(data):
+    return xxhash.xxh3_64_digest(data)
+
+ALGORITHMS = {
+    # md5 is what rows written before per-chat algorithms were hashed with
+    "md5": _md5,
+    "blake2b": _blake2b,
+}
+if xxhash is not None:
+    ALGORITHMS["xxh3"] = _xxh3
+
+LEGACY_ALGORITHM = "md5"
+DEFAULT_ALGORITHM = "xxh3" if xxhash is not None else "blake2b"
+
+def get_algorithm(name):
+    try:
+        return ALGORITHMS[name]
+    except KeyError:
+        raise ValueError(f"Unknown or unavailable fingerprint algorithm: {name}") from None
+
+# Normalization runs before hashing so trivial edits (case, spacing, invisible
+# characters, styled letters) map to the same fingerprint. A normalizer's
+# output must never change once released: fingerprints are only comparable
+# under the same name, so behaviour changes get a new name.
+# Format and filler characters that render as nothing: soft hyphen, combining
+# grapheme joiner, Arabic letter mark, Hangul fillers, Khmer and Mongolian
+# vowel/variation marks, zero-width and bidi controls, variation selectors
+_INVISIBLE = re.compile(
+    "[\u00ad\u034f\u061c\u115f\u1160\u17b4\u17b5\u180b-\u180f\u200b-\u200f\u202a-\u202e"
+    "\u2060-\u206f\u3164\ufe00-\ufe0f\ufeff\uffa0\U000e0100-\U000e01ef]+"
+)
+_EMOJI_RANGES = (
+    "\u2190-\u21ff\u2300-\u23ff\u2460-\u24ff\u25a0-\u27bf\u2900-\u297f\u2b00-\u2bff"
+    "\u3030\u303d\u3297\u3299\U0001f000-\U0001faff\U000e0020-\U000e007f"
+)
+_EMOJI = re.compile(f"[{_EMOJI_RANGES}]+")
+# Punctuation and symbols other than emoji
+_PUNCTUATION = re.compile(f"(?:[^\\w\\s{_EMOJI_RANGES}]|_)+")
+# The same for ASCII-only text, where a byte table is much faster than a regex;
+# built from the regex so both paths replace exactly the same characters,
+# control characters included
+_ASCII_REMOVED = bytes(code for code in range(128) if _PUNCTUATION.fullmatch(chr(code)))
+_ASCII_PUNCTUATION = bytes.maketrans(_ASCII_REMOVED, b" " * len(_ASCII_REMOVED))
+
+def _raw(text):
+    return text
+
+def _normalizer_v1(punctuation=False, emoji=False):
+    def normalize(text):
+        if text.isascii():
+            # Already NFKC with nothing invisible or emoji; casefold is lower
+            text = text.lower()
+            stripped = text.encode().translate(_ASCII_PUNCTUATION).decode() if punctuation else text
+        else:
+            if not unicodedata.is_normalized("NFKC", text):
+                text = unicodedata.normalize("NFKC", text)
+            text = _INVISIBLE.sub("", text).casefold()
+            stripped = text
+            if punctuation:
+                stripped = _PUNCTUATION.sub(" ", stripped)
+            if emoji:
+                stripped = _EMOJI.sub(" ", stripped)
+        # A message made only of removed characters keeps them, so it still
+        # differs from other such messages
+        if stripped and not stripped.isspace():
+            text = stripped
+        return " ".join(text.split())
+    return normalize
+
+NORMALIZERS = {
+    # raw is what fingerprints written before normalization were hashed from
+    "raw": _raw,
+    # NFKC, invisible characters stripped, whitespace collapsed, casefolded
+    "v1": _normalizer_v1(),
+    "v1-punct": _normalizer_v1(punctuation=True),
+    "v1-emoji": _normalizer_v1(emoji=True),
+    "v1-punct-emoji": _normalizer_v1(punctuation=True, emoji=True),
+}
+
+LEGACY_NORMALIZER = "raw"
+DEFAULT_NORMALIZER = "v1"
+
+def get_normalizer(name):
+    try:
+        return NORMALIZERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown fingerprint normalizer: {name}") from None
+
+def fingerprint(text, algorithm=DEFAULT_ALGORITHM, normalizer=DEFAULT_NORMALIZER):
+    return get_algorithm(algorithm)(get_normalizer(normalizer)(text).encode())
+
+# Near-duplicate signatures: MinHash over the distinct words of the v1-punct
+# form. Each of the MINHASH_SIZE 16-bit values is the minimum of one word hash
+# slice, so two messages agree on a value with probability equal to the
+# Jaccard similarity of their word sets. Words are hashed with blake2b so
+# signatures stored in the database stay comparable whatever is installed
+MINHASH_SIZE = 32
+_MINHASH_FORMAT = f"<{MINHASH_SIZE}H"
+
+def minhash(text, min_words=1):
+    words = set(NORMALIZERS["v1-punct"](text).split())
+    if len(words) < min_words:
+        return None
+    rows = [struct.unpack(_MINHASH_FORMAT, hashlib.blake2b(word.encode(), digest_size=64).digest()) for word in words]
+    return struct.pack(_MINHASH_FORMAT, *map(min, zip(*rows)))
+
+def minhash_similarity(a, b):
+    # Estimated Jaccard similarity: the share of values the signatures agree on
+    same = sum(x == y for x, y in zip(struct.unpack(_MINHASH_FORMAT, a), struct.unpack(_MINHASH_FORMAT, b)))
+    return same / MINHASH_SIZE
+
+# Perceptual hash for images: a 64-bit difference hash of brightness gradients
+# in a 9x8 grayscale thumbnail, which survives re-encoding, resizing and small
+# edits. Pillow is optional; this runs in a worker process
+IMAGE_HASH_BITS = 64
+
+def image_hash(data):
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG can decode straight at a reduced scale
+        image.draft("L", (64, 64))
+        pixels = list(image.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(row * 9, row * 9 + 8):
+            value = (value << 1) | (pixels[col] > pixels[col + 1])
+    return value
+
+# Links are keyed on a canonical form so the same target matches whatever
+# tracking parameters, scheme or mirror host it is posted with. Shorteners that
+# encode the target in the URL itself are expanded; others (bit.ly, ...) would
+# need a network round trip and are kept as they are
+_TRACKING_PARAMS = {
+    "fbclid", "gclid", "dclid", "gbraid", "wbraid", "msclkid", "yclid", "twclid", "ttclid",
+    "igshid", "igsh", "mc_cid", "mc_eid", "_ga", "_gl", "ref_src", "ref_url", "spm",
+}
+# Share-tracking parameters that only mean that on these hosts
+_HOST_TRACKING_PARAMS = {
+    "youtube.com": {"si", "feature", "pp", "t"},
+    "open.spotify.com": {"si"},
+    "x.com": {"s", "t"},
+    "instagram.com": {"img_index"},
+    "tiktok.com": {"is_from_webapp", "sender_device", "_r", "_t"},
+}
+_HOST_ALIASES = {
+    "m.youtube.com": "youtube.com", "music.youtube.com": "youtube.com", "youtube-nocookie.com": "youtube.com",
+    "twitter.com": "x.com", "mobile.twitter.com": "x.com", "mobile.x.com": "x.com",
+    "m.facebook.com": "facebook.com", "mbasic.facebook.com": "facebook.com", "fb.com": "facebook.com",
+    "m.tokopedia.com": "tokopedia.com", "m.shopee.co.id": "shopee.co.id", "m.tiktok.com": "tiktok.com",
+    "telegram.me": "t.me", "telegram.dog": "t.me",
+}
+_YOUTUBE_ID_PATH = re.compile(r"^/(?:shorts|embed|live|v)/([\w-]{6,})")
+# A scheme without "//"; a colon followed by digits is a port instead
+_SCHEME = re.compile(r"^[a-z][a-z0-9+.-]*:(?!\d)", re.IGNORECASE)
+
+def canonical_url(url):
+    # None for anything that does not parse as a web link
+    url = url.strip()
+    # Bare "host/path" links get a scheme; "mailto:" and the like keep theirs
+    if "://" not in url and not _SCHEME.match(url):
+        url = "http://" + url
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return None
+    if parts.scheme.lower() not in ("http", "https") or not parts.hostname:
+        return None
+
+    host = parts.hostname.rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    host = _HOST_ALIASES.get(host, host)
+    path = parts.path
+    query = parse_qsl(parts.query, keep_blank_values=True)
+
+    video = None
+    if host == "youtu.be":
+        host, video = "youtube.com", path.strip("/")
+    elif host == "youtube.com":
+        match = _YOUTUBE_ID_PATH.match(path)
+        video = match and match.group(1)
+    if video:
+        path, query = "/watch", [("v", video)] + query
+
+    dropped = _HOST_TRACKING_PARAMS.get(host, ())
+    query = [
+        (key, value) for key, value in query
+        if not key.startswith("utm_") and key not in _TRACKING_PARAMS and key not in dropped
+    ]
+
+    netloc = host if port in (None, 80, 443) else f"{host}:{port}"
+    # Scheme and fragment never change the target for dedupe purposes
+    return netloc + (path.rstrip("/") or "") + ("?" + urlencode(sorted(query)) if query else "")
@@ -0,0 +1,444 @@
+import os
+import sys
+import re
+import asyncio
+import logging
+from datetime import datetime, timedelta
+import psycopg
+from psycopg import errors, sql
+from dotenv import load_dotenv
+from fingerprint import LEGACY_ALGORITHM, LEGACY_NORMALIZER
+
+# Versioned schema migrations. The bot runs them at startup; they can also be
+# applied ahead of a deploy with `python migrations.py`
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+# Time-partition messages ('none', 'month' or 'week'); an existing table is
+# migrated in place by attaching it as the oldest partition
+MESSAGES_PARTITIONING = os.getenv('MESSAGES_PARTITIONING', 'none').lower()
+PARTITIONS_AHEAD = int(os.getenv('PARTITIONS_AHEAD', 3))
+
+# Column compression for stored message text ('pglz' or 'lz4', PostgreSQL 14+)
+MESSAGE_TEXT_COMPRESSION = os.getenv('MESSAGE_TEXT_COMPRESSION', '').lower()
+
+# Rows per transaction when backfilling existing data during migrations
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', 5000))
+
+# Session advisory lock held while migrating, so only one process applies them
+MIGRATION_LOCK_KEY = 0x6d736773
+
+if MESSAGES_PARTITIONING not in ('none', 'month', 'week'):
+    raise ValueError(f"❌ MESSAGES_PARTITIONING '{MESSAGES_PARTITIONING}' must be none, month or week!")
+if MESSAGE_TEXT_COMPRESSION not in ('', 'pglz', 'lz4'):
+    raise ValueError(f"❌ MESSAGE_TEXT_COMPRESSION '{MESSAGE_TEXT_COMPRESSION}' must be pglz or lz4!")
+
+async def backfill_fingerprints(conn):
+    # Walk the primary key in fixed ranges so each UPDATE is a short transaction
+    cursor = await conn.execute("SELECT coalesce(max(id), 0) FROM messages")
+    (max_id,) = await cursor.fetchone()
+    updated = 0
+    for low in range(0, max_id, MIGRATION_BATCH_SIZE):
+        cursor = await conn.execute(
+            "UPDATE messages SET fingerprint = decode(message_hash, 'hex') "
+            "WHERE id > %s AND id <= %s AND fingerprint IS NULL AND message_hash IS NOT NULL",
+            (low, low + MIGRATION_BATCH_SIZE)
+        )
+        updated += cursor.rowcount
+    logger.info(f"🧬 Backfilled {updated} fingerprints")
+
+def period_start(moment):
+    if MESSAGES_PARTITIONING == 'week':
+        day = moment.date() - timedelta(days=moment.weekday())
+    else:
+        day = moment.date().replace(day=1)
+    return datetime(day.year, day.month, day.day)
+
+def next_period(start):
+    if MESSAGES_PARTITIONING == 'week':
+        return start + timedelta(days=7)
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+async def list_partitions(conn):
+    # (name, upper bound) for every partition of messages; MAXVALUE has no bound
+    cursor = await conn.execute(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'messages'::regclass"
+    )
+    partitions = []
+    for name, bound in await cursor.fetchall():
+        match = re.search(r"TO \('([^']+)'\)", bound)
+        partitions.append((name, datetime.fromisoformat(match.group(1)) if match else None))
+    return partitions
+
+async def ensure_partitions(conn):
+    # Current period plus PARTITIONS_AHEAD upcoming ones; periods already
+    # covered (e.g. by an attached legacy table) are skipped
+    start = period_start(datetime.now())
+    for _ in range(PARTITIONS_AHEAD + 1):
+        end = next_period(start)
+        try:
+            await conn.execute(sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF messages FOR VALUES FROM ({}) TO ({})"
+            ).format(sql.Identifier(f"messages_p{start:%Y%m%d}"), sql.Literal(start), sql.Literal(end)))
+        except errors.InvalidObjectDefinition:
+            pass
+        start = end
+
+async def create_partitioned_messages(conn):
+    await conn.execute("CREATE SEQUENCE IF NOT EXISTS messages_id_seq")
+    await conn.execute('''
+        CREATE TABLE messages (
+            id BIGINT NOT NULL DEFAULT nextval('messages_id_seq'),
+            chat_id BIGINT,
+            fingerprint BYTEA,
+            message_text TEXT,
+            user_id BIGINT,
+            timestamp TIMESTAMP NOT NULL,
+            user_name TEXT DEFAULT 'Unknown',
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    ''')
+    await conn.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+
+async def migrate_to_partitioned(conn):
+    # The existing heap becomes one partition covering everything up to the
+    # current period, so no rows are copied; retention drops it as a whole later.
+    # Scans and index builds happen first without blocking writes, so the
+    # locked part only changes the catalog
+    cursor = await conn.execute("SELECT max(timestamp) FROM messages")
+    (newest,) = await cursor.fetchone()
+    upper = period_start(datetime.now())
+    if newest is not None and newest >= upper:
+        upper = next_period(period_start(newest))
+
+    # ATTACH reuses a matching unique index for the parent's (id, timestamp) key
+    cursor = await conn.execute(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('messages_id_timestamp_key')"
+    )
+    row = await cursor.fetchone()
+    if row is None or not row[0]:
+        await conn.execute("DROP INDEX CONCURRENTLY IF EXISTS messages_id_timestamp_key")
+        await conn.execute("CREATE UNIQUE INDEX CONCURRENTLY messages_id_timestamp_key ON messages (id, timestamp)")
+    # A validated CHECK lets SET NOT NULL and ATTACH skip their own scans;
+    # added NOT VALID and validated separately, neither step blocks writes
+    await conn.execute("ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_legacy_bound")
+    await conn.execute(sql.SQL(
+        "ALTER TABLE messages ADD CONSTRAINT messages_legacy_bound "
+        "CHECK (timestamp IS NOT NULL AND timestamp < {}) NOT VALID"
+    ).format(sql.Literal(upper)))
+    await conn.execute("ALTER TABLE messages VALIDATE CONSTRAINT messages_legacy_bound")
+
+    async with conn.transaction():
+        await conn.execute("ALTER TABLE messages RENAME TO messages_legacy")
+        cursor = await conn.execute("SELECT pg_get_serial_sequence('messages_legacy', 'id')")
+        (sequence,) = await cursor.fetchone()
+        await conn.execute("ALTER TABLE messages_legacy DROP CONSTRAINT IF EXISTS messages_pkey")
+        cursor = await conn.execute(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = 'messages_legacy'"
+        )
+        for (index,) in await cursor.fetchall():
+            await conn.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                sql.Identifier(index), sql.Identifier(('legacy_' + index)[:63])
+            ))
+
+        await conn.execute("CREATE TABLE messages (LIKE messages_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp)")
+        await conn.execute("ALTER TABLE messages ADD PRIMARY KEY (id, timestamp)")
+        if sequence:
+            # Otherwise dropping the legacy partition would drop the id sequence with it
+            await conn.execute(sql.SQL("ALTER SEQUENCE {} OWNED BY messages.id").format(sql.SQL(sequence)))
+
+        await conn.execute("ALTER TABLE messages_legacy ALTER COLUMN timestamp SET NOT NULL")
+        await conn.execute(sql.SQL(
+            "ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO ({})"
+        ).format(sql.Literal(upper)))
+    logger.info(f"🧱 messages migrated to {MESSAGES_PARTITIONING}ly partitions (legacy rows before {upper:%Y-%m-%d})")
+
+async def messages_kind(conn):
+    # 'r' plain table, 'p' partitioned, None when it does not exist yet
+    cursor = await conn.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('messages')")
+    row = await cursor.fetchone()
+    return row[0] if row else None
+
+async def ensure_history_index(conn):
+    # Covering index for the history queries: the window's slice is already in
+    # time order and carries user_name, so they can be answered index-only.
+    # Built CONCURRENTLY (the pool is in autocommit) so writes keep flowing
+    cursor = await conn.execute(
+        "SELECT (SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('idx_chat_fingerprint_cover')), "
+        "       relkind FROM pg_class WHERE oid = 'messages'::regclass"
+    )
+    valid, kind = await cursor.fetchone()
+    if not valid:
+        if kind != 'p':
+            if valid is not None:
+                # Leftover of an interrupted concurrent build
+                await conn.execute('DROP INDEX CONCURRENTLY IF EXISTS idx_chat_fingerprint_cover')
+            await conn.execute(
+                'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chat_fingerprint_cover '
+                'ON messages (chat_id, fingerprint, timestamp) INCLUDE (user_name)'
+            )
+        else:
+            # Partitioned tables cannot index concurrently: create the parent
+            # index on its own, build each missing partition index concurrently
+            # and attach it; the parent turns valid once every partition has one
+            await conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_chat_fingerprint_cover '
+                'ON ONLY messages (chat_id, fingerprint, timestamp) INCLUDE (user_name)'
+            )
+            cursor = await conn.execute(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = 'messages'::regclass AND NOT EXISTS ("
+                "  SELECT 1 FROM pg_inherits ii JOIN pg_index x ON x.indexrelid = ii.inhrelid "
+                "  WHERE ii.inhparent = 'idx_chat_fingerprint_cover'::regclass AND x.indrelid = c.oid)"
+            )
+            for (partition,) in await cursor.fetchall():
+                index = sql.Identifier(f"{partition}_cover"[:63])
+                existing = None
+                if partition == 'messages_legacy':
+                    # A migrated table may already carry the index under its legacy_ name
+                    cursor = await conn.execute(
+                        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('legacy_idx_chat_fingerprint_cover')"
+                    )
+                    existing = await cursor.fetchone()
+                if existing is not None and existing[0]:
+                    index = sql.Identifier('legacy_idx_chat_fingerprint_cover')
+                else:
+                    await conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(index))
+                    await conn.execute(sql.SQL(
+                        "CREATE INDEX CONCURRENTLY {} ON {} (chat_id, fingerprint, timestamp) INCLUDE (user_name)"
+                    ).format(index, sql.Identifier(partition)))
+                await conn.execute(
+                    sql.SQL("ALTER INDEX idx_chat_fingerprint_cover ATTACH PARTITION {}").format(index)
+                )
+        logger.info("🗂️ Covering history index ready")
+
+async def create_messages(conn):
+    kind = await messages_kind(conn)
+    if kind is None and MESSAGES_PARTITIONING != 'none':
+        await create_partitioned_messages(conn)
+        await ensure_partitions(conn)
+    elif kind is None:
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id SERIAL PRIMARY KEY,
+                chat_id BIGINT,
+                fingerprint BYTEA,
+                message_text TEXT,
+                user_id BIGINT,
+                timestamp TIMESTAMP,
+                user_name TEXT DEFAULT 'Unknown'
+            )
+        ''')
+    # Drop old unique constraint if it exists
+    try:
+        await conn.execute('ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_chat_id_message_hash_key')
+    except Exception:
+        pass
+
+    # hex md5 TEXT -> raw BYTEA fingerprint, backfilled in id batches
+    await conn.execute('ALTER TABLE messages ADD COLUMN IF NOT EXISTS fingerprint BYTEA')
+    cursor = await conn.execute("SELECT to_regclass('idx_chat_hash') IS NOT NULL")
+    (legacy_index,) = await cursor.fetchone()
+    if legacy_index:
+        await backfill_fingerprints(conn)
+        await conn.execute('DROP INDEX IF EXISTS idx_chat_hash')
+
+async def create_fingerprints(conn):
+    # Per-chat summary of every distinct message, kept by UPSERT on the hot path;
+    # message text is kept here once instead of on every occurrence
+    cursor = await conn.execute("SELECT to_regclass('fingerprints') IS NULL")
+    (new_summary,) = await cursor.fetchone()
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            chat_id BIGINT,
+            fingerprint BYTEA,
+            first_user_name TEXT,
+            first_seen TIMESTAMP,
+            last_user_name TEXT,
+            last_seen TIMESTAMP,
+            occurrences BIGINT NOT NULL DEFAULT 0,
+            previous_seen TIMESTAMP,
+            message_text TEXT,
+            PRIMARY KEY (chat_id, fingerprint)
+        )
+    ''')
+    if new_summary:
+        # Build the summary from existing history once
+        await conn.execute('''
+            INSERT INTO fingerprints
+                (chat_id, fingerprint, first_user_name, first_seen, last_user_name, last_seen, occurrences,
+                 message_text)
+            SELECT chat_id, fingerprint,
+                   (array_agg(user_name ORDER BY timestamp ASC))[1], min(timestamp),
+                   (array_agg(user_name ORDER BY timestamp DESC))[1], max(timestamp),
+                   count(*),
+                   (array_agg(message_text ORDER BY timestamp ASC))[1]
+            FROM messages
+            WHERE fingerprint IS NOT NULL
+            GROUP BY chat_id, fingerprint
+            ON CONFLICT DO NOTHING
+        ''')
+
+async def create_chat_settings(conn):
+    # Per-chat settings; the fingerprint algorithm is pinned per chat so
+    # existing rows keep matching when the default changes
+    cursor = await conn.execute("SELECT to_regclass('chat_settings') IS NULL")
+    (new_settings,) = await cursor.fetchone()
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id BIGINT PRIMARY KEY,
+            fingerprint_algo TEXT NOT NULL,
+            window_hours REAL,
+            retention_days INTEGER
+        )
+    ''')
+    if new_settings:
+        # Chats with history were hashed with md5
+        await conn.execute(
+            "INSERT INTO chat_settings (chat_id, fingerprint_algo) "
+            "SELECT DISTINCT chat_id, %s FROM fingerprints ON CONFLICT DO NOTHING",
+            (LEGACY_ALGORITHM,)
+        )
+
+async def create_processed_updates(conn):
+    # update_ids already handled by any replica (UPDATE_DEDUP_DB)
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            received_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+    ''')
+
+async def add_chat_normalizer(conn):
+    # Chats with history were fingerprinted from the raw text, as are chats
+    # created by a bot version that does not set the normalizer yet
+    await conn.execute(sql.SQL(
+        "ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS normalizer TEXT NOT NULL DEFAULT {}"
+    ).format(sql.Literal(LEGACY_NORMALIZER)))
+
+async def add_fingerprint_minhash(conn):
+    # Near-duplicate signature, written with a fingerprint's first occurrence
+    await conn.execute('ALTER TABLE fingerprints ADD COLUMN IF NOT EXISTS minhash BYTEA')
+
+async def add_fingerprint_phash(conn):
+    # Perceptual hash of a media fingerprint's thumbnail, set after its first occurrence
+    await conn.execute('ALTER TABLE fingerprints ADD COLUMN IF NOT EXISTS phash BIGINT')
+
+# Append only: a step runs once per database and must cope with the schema
+# left behind by the ad-hoc startup DDL that predates this table
+MIGRATIONS = [
+    (1, "messages with BYTEA fingerprints", create_messages),
+    (2, "fingerprints summary", create_fingerprints),
+    (3, "chat_settings", create_chat_settings),
+    (4, "processed_updates", create_processed_updates),
+    (5, "covering history index", ensure_history_index),
+    (6, "per-chat text normalizer", add_chat_normalizer),
+    (7, "fingerprint minhash", add_fingerprint_minhash),
+    (8, "fingerprint phash", add_fingerprint_phash),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+COMPRESSION_CODES = {'pglz': 'p', 'lz4': 'l'}
+
+async def current_version(conn):
+    cursor = await conn.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    (exists,) = await cursor.fetchone()
+    if not exists:
+        return 0
+    cursor = await conn.execute("SELECT coalesce(max(version), 0) FROM schema_version")
+    (version,) = await cursor.fetchone()
+    return version
+
+async def compression_pending(conn):
+    if not MESSAGE_TEXT_COMPRESSION:
+        return False
+    try:
+        cursor = await conn.execute(
+            "SELECT count(*) FROM pg_attribute "
+            "WHERE attrelid IN (to_regclass('messages'), to_regclass('fingerprints')) "
+            "AND attname = 'message_text' AND attcompression = %s",
+            (COMPRESSION_CODES[MESSAGE_TEXT_COMPRESSION],)
+        )
+    except errors.UndefinedColumn:
+        # No column compression before PostgreSQL 14
+        return False
+    (applied,) = await cursor.fetchone()
+    return applied < 2
+
+async def apply_compression(conn):
+    # lz4 also needs a server built with it
+    try:
+        for table in ('messages', 'fingerprints'):
+            await conn.execute(sql.SQL("ALTER TABLE {} ALTER COLUMN message_text SET COMPRESSION {}").format(
+                sql.Identifier(table), sql.SQL(MESSAGE_TEXT_COMPRESSION)
+            ))
+    except errors.Error as e:
+        logger.warning(f"⚠️ Text compression not applied: {e}")
+
+async def pending_changes(conn):
+    # Catalog reads only, so a current schema costs a few cheap queries per boot
+    version = await current_version(conn)
+    changes = [f"{number}: {name}" for number, name, _ in MIGRATIONS if number > version]
+    if MESSAGES_PARTITIONING != 'none' and await messages_kind(conn) == 'r':
+        changes.append(f"partition messages by {MESSAGES_PARTITIONING}")
+    if not changes and await compression_pending(conn):
+        changes.append(f"{MESSAGE_TEXT_COMPRESSION} text compression")
+    return changes
+
+async def migrate(conn):
+    # conn must be in autocommit: concurrent index builds cannot run in a transaction
+    if not await pending_changes(conn):
+        return False
+    await conn.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+    try:
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+        ''')
+        # Another process may have migrated while we waited for the lock
+        version = await current_version(conn)
+        for number, name, step in MIGRATIONS:
+            if number <= version:
+                continue
+            logger.info(f"📐 Applying migration {number}: {name}")
+            await step(conn)
+            await conn.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (number, name))
+
+        if MESSAGES_PARTITIONING != 'none' and await messages_kind(conn) == 'r':
+            await migrate_to_partitioned(conn)
+            await ensure_partitions(conn)
+            await ensure_history_index(conn)
+        if await compression_pending(conn):
+            await apply_compression(conn)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+    logger.info(f"📐 Schema at version {LATEST_VERSION}")
+    return True
+
+async def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    if not DATABASE_URL:
+        logger.error("❌ DATABASE_URL not set!")
+        return 1
+    async with await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True) as conn:
+        if "--check" in sys.argv[1:]:
+            # Exit status 1 when the schema needs migrating, e.g. to gate a deploy
+            changes = await pending_changes(conn)
+            for change in changes:
+                print(change)
+            return 1 if changes else 0
+        await migrate(conn)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
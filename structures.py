@@ -0,0 +1,250 @@
+import math
+import time
+from collections import OrderedDict
+
+from fingerprint import IMAGE_HASH_BITS, MINHASH_SIZE, minhash_similarity
+
+# In-process structures behind the duplicate check: caches, Bloom filters and
+# near-duplicate indexes. They keep no connections, so they can be tested alone
+
+class SeenUpdates:
+    # Insertion-ordered, so expired ids are always at the front and both the
+    # lookup and the eviction are O(1)
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.dropped = 0
+
+    def add(self, update_id):
+        now = time.monotonic()
+        while self.entries:
+            oldest_id, expires = next(iter(self.entries.items()))
+            if expires > now and len(self.entries) < self.max_size:
+                break
+            del self.entries[oldest_id]
+        if update_id in self.entries:
+            self.dropped += 1
+            return False
+        self.entries[update_id] = now + self.ttl
+        return True
+
+    def discard(self, update_id):
+        self.entries.pop(update_id, None)
+
+    def stats(self):
+        return {"size": len(self.entries), "max_size": self.max_size, "dropped": self.dropped}
+
+class OccurrenceCache:
+    # LRU of (chat_id, fingerprint) -> first sender, count and last senders,
+    # so hot repeats are reported without reading the history back
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if time.monotonic() - entry.cached_at > self.ttl:
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate_chat(self, chat_id):
+        for key in [key for key in self.entries if key[0] == chat_id]:
+            del self.entries[key]
+
+    def stats(self):
+        return {
+            "size": len(self.entries), "max_entries": self.max_entries,
+            "hits": self.hits, "misses": self.misses, "stale": self.stale,
+            "evictions": self.evictions, "expirations": self.expirations,
+        }
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate, max_bytes):
+        self.capacity = capacity
+        self.count = 0
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.size = max(8, min(bits, max_bytes * 8))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, fingerprint):
+        # Fingerprints are already uniform hashes, so their halves seed double hashing
+        value = int.from_bytes(fingerprint[:8], 'little')
+        h1, h2 = value & 0xFFFFFFFF, (value >> 32) | 1
+        # The cubic term (enhanced double hashing) keeps small filters from
+        # probing correlated positions, which pushed them past their error rate
+        return [(h1 + i * h2 + (i ** 3 - i) // 6) % self.size for i in range(self.hashes)]
+
+    def add(self, fingerprint):
+        for position in self._positions(fingerprint):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, fingerprint):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(fingerprint))
+
+class ScalableBloomFilter:
+    # Layers of Bloom filters: when the newest is full another one twice as
+    # large, at half the error rate, is added, so the combined false-positive
+    # rate stays under error_rate. Past max_bytes the newest layer just fills up
+    def __init__(self, capacity, error_rate, max_bytes):
+        self.error_rate = error_rate / 2
+        self.max_bytes = max_bytes
+        self.layers = [BloomFilter(capacity, self.error_rate, max_bytes)]
+
+    @property
+    def bytes(self):
+        return sum(len(layer.bits) for layer in self.layers)
+
+    def add(self, fingerprint):
+        # Repeats are not counted towards a layer's capacity
+        if fingerprint in self:
+            return
+        layer = self.layers[-1]
+        if layer.count >= layer.capacity and self.max_bytes - self.bytes >= 2 * len(layer.bits):
+            layer = BloomFilter(
+                2 * layer.capacity, self.error_rate / 2 ** len(self.layers), self.max_bytes - self.bytes
+            )
+            self.layers.append(layer)
+        layer.add(fingerprint)
+        layer.count += 1
+
+    def __contains__(self, fingerprint):
+        return any(fingerprint in layer for layer in self.layers)
+
+IMAGE_HASH_MASK = (1 << IMAGE_HASH_BITS) - 1
+
+def to_bigint(signature):
+    # Signatures are unsigned; BIGINT columns are signed
+    if signature is None:
+        return None
+    return signature - (1 << IMAGE_HASH_BITS) if signature >> (IMAGE_HASH_BITS - 1) else signature
+
+class SimilarityIndex:
+    # Banded LSH: entries sharing a band key with the signature are candidates,
+    # and candidates at least min_similarity alike match. Entries are keyed by
+    # fingerprint, oldest evicted first; column is where fingerprints persists
+    # the signatures
+    def __init__(self, column, enabled, min_similarity, max_entries):
+        self.column = column
+        self.enabled = enabled
+        self.min_similarity = min_similarity
+        self.max_entries = max_entries
+        self.chats = {}
+        self.lookups = 0
+        self.candidates = 0
+        self.matches = 0
+
+    def add(self, chat_id, signature, key):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            # (key -> signature in insertion order, band key -> keys)
+            chat = self.chats[chat_id] = ({}, {})
+        entries, buckets = chat
+        if key in entries:
+            return
+        entries[key] = signature
+        for band_key in self.band_keys(signature):
+            buckets.setdefault(band_key, []).append(key)
+        if len(entries) > self.max_entries:
+            self.remove(chat_id, next(iter(entries)))
+
+    def remove(self, chat_id, key):
+        chat = self.chats.get(chat_id)
+        if chat is None or key not in chat[0]:
+            return
+        entries, buckets = chat
+        for band_key in self.band_keys(entries.pop(key)):
+            bucket = buckets[band_key]
+            bucket.remove(key)
+            if not bucket:
+                del buckets[band_key]
+
+    def find(self, chat_id, signature, exclude=None):
+        # (key, similarity) of the most similar entry above the threshold, or None
+        self.lookups += 1
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return None
+        entries, buckets = chat
+        best, checked = None, set()
+        for band_key in self.band_keys(signature):
+            for key in buckets.get(band_key, ()):
+                if key == exclude or key in checked:
+                    continue
+                checked.add(key)
+                similarity = self.similarity(entries[key], signature)
+                if similarity >= self.min_similarity and (best is None or similarity > best[1]):
+                    best = (key, similarity)
+        self.candidates += len(checked)
+        self.matches += best is not None
+        return best
+
+    def stats(self):
+        return {
+            "enabled": self.enabled, "chats": len(self.chats),
+            "entries": sum(len(entries) for entries, _ in self.chats.values()),
+            "bands": len(self.bands), "lookups": self.lookups,
+            "candidates": self.candidates, "matches": self.matches,
+        }
+
+class HammingIndex(SimilarityIndex):
+    # 64-bit signatures within max_distance bits differ in at most max_distance
+    # of max_distance + 1 bands, so they agree exactly on at least one
+    def __init__(self, column, enabled, max_distance, max_entries):
+        super().__init__(column, enabled, 1 - max_distance / IMAGE_HASH_BITS, max_entries)
+        count = max_distance + 1
+        edges = [IMAGE_HASH_BITS * i // count for i in range(count + 1)]
+        self.bands = [(low, (1 << (high - low)) - 1) for low, high in zip(edges, edges[1:])]
+
+    def band_keys(self, signature):
+        return [(band, (signature >> low) & mask) for band, (low, mask) in enumerate(self.bands)]
+
+    def similarity(self, a, b):
+        return 1 - (a ^ b).bit_count() / IMAGE_HASH_BITS
+
+    def load(self, value):
+        return value & IMAGE_HASH_MASK
+
+class MinHashIndex(SimilarityIndex):
+    # 10 bands of 3 values (6 bytes of the signature each): word sets with
+    # Jaccard similarity s share a band with probability 1 - (1 - s^3)^10,
+    # 97% for one word replaced in five and 8% at s = 0.2
+    ROWS = 3
+
+    def __init__(self, column, enabled, min_similarity, max_entries):
+        super().__init__(column, enabled, min_similarity, max_entries)
+        self.bands = range(MINHASH_SIZE // self.ROWS)
+
+    def band_keys(self, signature):
+        width = 2 * self.ROWS
+        return [(band, signature[band * width:(band + 1) * width]) for band in self.bands]
+
+    def similarity(self, a, b):
+        return minhash_similarity(a, b)
+
+    def load(self, value):
+        return bytes(value)
@@ -0,0 +1,80 @@
+import importlib
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+@pytest.fixture(scope="module")
+def bot():
+    for name in ("telegram", "psycopg", "psycopg_pool", "starlette", "uvicorn", "dotenv"):
+        pytest.importorskip(name)
+    os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+    return importlib.import_module("bot")
+
+def senders(count, start=datetime(2024, 1, 1, 8, 0, 0)):
+    return [(f"user_{i}", start + timedelta(minutes=i)) for i in range(1, count + 1)]
+
+def report_lines(report):
+    header, senders = report.split("\n\n")
+    return header.split("\n"), senders.split("\n")
+
+def test_build_report_labels(bot):
+    first, second = senders(2)
+    header, lines = report_lines(bot.build_report("promo_hari ini", first, [second], 2))
+    assert header == ["❌**DETEKSI DITEMUKAN**❌", "Isi pesan : promo\\_hari ini"]
+    assert lines == [
+        "user\\_1 : Pengirim pertama kali 08:01:00",
+        "user\\_2 : Pengirim saat ini 08:02:00",
+    ]
+
+    first, *recent = senders(4)
+    _, lines = report_lines(bot.build_report("promo", first, recent, 4))
+    assert [line.split(" : ")[1][:-9] for line in lines] == [
+        "Pengirim pertama kali", "pengirim kedua kali", "pengirim ke-3", "Pengirim saat ini",
+    ]
+
+def test_build_report_collapses_middle(bot):
+    # Only the latest senders are listed; the rest become one line
+    first, *recent = senders(5)
+    _, lines = report_lines(bot.build_report("promo", first, recent[-2:], 1234))
+    assert lines == [
+        "user\\_1 : Pengirim pertama kali 08:01:00",
+        "... dan 1,231 lainnya",
+        "user\\_4 : pengirim ke-1233 08:04:00",
+        "user\\_5 : Pengirim saat ini 08:05:00",
+    ]
+
+    # No collapsed line when every sender is listed, however many are cached
+    _, lines = report_lines(bot.build_report("promo", first, recent, 3))
+    assert len(lines) == 3 and not any(line.startswith("...") for line in lines)
+
+def test_build_report_similarity_and_limits(bot):
+    first, second = senders(2)
+    header, _ = report_lines(bot.build_report("x" * (bot.REPORT_TEXT_MAX_CHARS + 10), first, [second], 2, 0.875))
+    assert header[1] == "Isi pesan : " + "x" * bot.REPORT_TEXT_MAX_CHARS + "…"
+    assert header[2] == "Kemiripan : 88%"
+    report = bot.build_report("y" * 10000, first, [second], 2)
+    assert len(report) <= bot.TELEGRAM_MESSAGE_LIMIT
+
+def test_summary_columns(bot):
+    # Rows of one (chat, fingerprint) become one summary: first sender kept,
+    # last sender and count from the batch, text and signature of the first row
+    (a1, t1), (a2, t2), (a3, t3), (b1, t4) = senders(4)
+    rows = [
+        (1, b"a", None, 11, t1, a1, "promo", b"sig"),
+        (2, b"a", None, 12, t2, a2, "lain", None),
+        (1, b"a", None, 13, t3, a3, "promo", b"sig"),
+        (1, b"b", None, 14, t4, b1, "baru", None),
+    ]
+    assert bot.summary_columns(rows) == [
+        (1, 2, 1),
+        (b"a", b"a", b"b"),
+        (a1, a2, b1),
+        (t1, t2, t4),
+        (a3, a2, b1),
+        (t3, t2, t4),
+        (2, 1, 1),
+        ("promo", "lain", "baru"),
+        (b"sig", None, None),
+    ]
+    assert bot.summary_columns([]) == []
@@ -0,0 +1,93 @@
+import string
+
+import pytest
+
+from fingerprint import NORMALIZERS, canonical_url, minhash, minhash_similarity
+
+# Fingerprints are stored, so normalizer output must never change once
+# released: a failure here means a new normalizer name is needed instead
+V1_NAMES = ("v1", "v1-punct", "v1-emoji", "v1-punct-emoji")
+
+NORMALIZED = [
+    # text, (v1, v1-punct, v1-emoji, v1-punct-emoji)
+    ("Hello   World!!", ("hello world!!", "hello world", "hello world!!", "hello world")),
+    ("  PROMO\tcode\n", ("promo code",) * 4),
+    ("\U0001d401\U0001d428\U0001d425\U0001d41d ｆｕｌｌ", ("bold full",) * 4),
+    ("ﬁle Straße ÉTÉ", ("file strasse été",) * 4),
+    # Zero-width, bidi and filler characters
+    ("pro\u200bmo\u2066co\u2069de\u00ad", ("promocode",) * 4),
+    ("a\u034fb\u061cc\u3164d\u115fe\ufe0f", ("abcde",) * 4),
+    (
+        "Diskon 50% \U0001f525\U0001f525 hari ini!",
+        (
+            "diskon 50% \U0001f525\U0001f525 hari ini!", "diskon 50 \U0001f525\U0001f525 hari ini",
+            "diskon 50% hari ini!", "diskon 50 hari ini",
+        ),
+    ),
+    ("snake_case-word", ("snake_case-word", "snake case word", "snake_case-word", "snake case word")),
+    # Messages made only of removed characters keep them
+    ("!!!", ("!!!",) * 4),
+    ("\U0001f525 \U0001f525", ("\U0001f525 \U0001f525",) * 4),
+    ("", ("",) * 4),
+]
+
+@pytest.mark.parametrize("text, expected", NORMALIZED)
+def test_normalizers(text, expected):
+    assert tuple(NORMALIZERS[name](text) for name in V1_NAMES) == expected
+    assert NORMALIZERS["raw"](text) == text
+
+ASCII_TEXTS = [
+    "Hello   World!!",
+    "BUY NOW: http://example.com/?a=1&b=2",
+    "snake_case-word (x) [y] {z}",
+    string.punctuation,
+    "a" + string.punctuation + "b",
+    " \t\n ",
+    "MiXeD 123 ~`'\"",
+    # Control characters count as punctuation on both paths
+    "a\x00b\x08c\x1bd\x7fe",
+    "".join(map(chr, range(128))),
+]
+
+@pytest.mark.parametrize("name", V1_NAMES)
+@pytest.mark.parametrize("text", ASCII_TEXTS)
+def test_ascii_fast_path(name, text):
+    # A zero-width space is stripped but sends the text down the Unicode path
+    normalize = NORMALIZERS[name]
+    assert normalize(text) == normalize(text + "\u200b")
+
+def test_minhash():
+    # Signatures are stored for the near-duplicate index
+    assert minhash("Promo GRATIS ongkir, hari ini saja!").hex() == (
+        "f70b8f2bd4107a59be14eb1c562c8f48510787778c6a9f1ec98034012b645812"
+        "86582118df048f6223657d321c7c99334122860dd52914546e23a05654300510"
+    )
+    assert minhash("hari ini saja", min_words=5) is None
+    signature = minhash("promo gratis ongkir hari ini saja")
+    assert minhash_similarity(signature, minhash("Saja ini hari ongkir gratis PROMO!!")) == 1
+    assert 0.3 < minhash_similarity(signature, minhash("promo gratis ongkir besok ini saja")) < 0.9
+
+# Canonical links are fingerprinted and stored as well
+CANONICAL_URLS = [
+    ("https://www.Example.com/Path/?utm_source=x&b=2&a=1#frag", "example.com/Path?a=1&b=2"),
+    ("HTTPS://EXAMPLE.COM./x/", "example.com/x"),
+    ("example.com", "example.com"),
+    ("https://example.com:443/", "example.com"),
+    ("https://example.com:8080/a?fbclid=1&gclid=2", "example.com:8080/a"),
+    ("https://shop.example.com/item?q=a+b%20c", "shop.example.com/item?q=a+b+c"),
+    ("http://youtu.be/dQw4w9WgXcQ?si=abc&t=10", "youtube.com/watch?v=dQw4w9WgXcQ"),
+    ("https://m.youtube.com/shorts/dQw4w9WgXcQ?feature=share", "youtube.com/watch?v=dQw4w9WgXcQ"),
+    ("https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PL1&pp=xyz", "youtube.com/watch?list=PL1&v=dQw4w9WgXcQ"),
+    ("https://twitter.com/user/status/123?s=20&t=abc", "x.com/user/status/123"),
+    ("https://open.spotify.com/track/abc?si=123", "open.spotify.com/track/abc"),
+    ("t.me/some_channel/42", "t.me/some_channel/42"),
+    ("https://telegram.me/some_channel", "t.me/some_channel"),
+    ("ftp://example.com/file", None),
+    ("tg://resolve?domain=x", None),
+    ("mailto:a@example.com", None),
+    ("http://[::1", None),
+]
+
+@pytest.mark.parametrize("url, expected", CANONICAL_URLS)
+def test_canonical_url(url, expected):
+    assert canonical_url(url) == expected
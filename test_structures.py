@@ -0,0 +1,165 @@
+import hashlib
+import random
+from types import SimpleNamespace
+
+import pytest
+
+import structures
+from fingerprint import minhash
+from structures import (
+    BloomFilter, HammingIndex, MinHashIndex, OccurrenceCache, ScalableBloomFilter, SeenUpdates, to_bigint,
+)
+
+def fingerprints(start, count):
+    return [hashlib.blake2b(str(i).encode(), digest_size=8).digest() for i in range(start, start + count)]
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(structures.time, "monotonic", lambda: clock.now)
+    return clock
+
+@pytest.mark.parametrize("added", [500, 5000, 30000])
+def test_bloom_filter(added):
+    # Never a false negative, and the layers together stay under error_rate
+    bloom = ScalableBloomFilter(1000, 0.01, 1 << 20)
+    members = fingerprints(0, added)
+    for fingerprint in members:
+        bloom.add(fingerprint)
+    assert all(fingerprint in bloom for fingerprint in members)
+    assert len(bloom.layers) > 1 or added <= 1000
+    others = fingerprints(added, 50000)
+    assert sum(fingerprint in bloom for fingerprint in others) / len(others) <= 0.01
+
+def test_bloom_filter_repeats_and_size():
+    bloom = ScalableBloomFilter(100, 0.01, 1 << 20)
+    for _ in range(10):
+        for fingerprint in fingerprints(0, 100):
+            bloom.add(fingerprint)
+    assert len(bloom.layers) == 1 and bloom.layers[0].count == 100
+
+    # Past max_bytes the newest layer keeps filling instead of growing
+    bloom = ScalableBloomFilter(100, 0.01, 1024)
+    members = fingerprints(0, 5000)
+    for fingerprint in members:
+        bloom.add(fingerprint)
+    assert bloom.bytes <= 1024
+    assert all(fingerprint in bloom for fingerprint in members)
+
+def test_bloom_filter_capacity():
+    bloom = BloomFilter(1000, 0.01, 1 << 20)
+    for fingerprint in fingerprints(0, 1000):
+        bloom.add(fingerprint)
+    others = fingerprints(1000, 50000)
+    assert sum(fingerprint in bloom for fingerprint in others) / len(others) < 0.015
+
+def test_seen_updates(clock):
+    seen = SeenUpdates(3, 60)
+    assert seen.add(1) and not seen.add(1)
+    assert seen.dropped == 1
+    clock.now += 61
+    assert seen.add(1)
+
+    # Oldest ids go first once the size limit is reached
+    assert seen.add(2) and seen.add(3) and seen.add(4)
+    assert list(seen.entries) == [2, 3, 4]
+    assert seen.add(1) and list(seen.entries) == [3, 4, 1]
+
+    seen.discard(4)
+    assert seen.add(4)
+
+def test_occurrence_cache(clock):
+    cache = OccurrenceCache(2, 60)
+    entry = lambda: SimpleNamespace(cached_at=clock.now)
+    cache.put("a", entry())
+    cache.put("b", entry())
+    assert cache.get("a") is not None
+    # "b" is now the least recently used
+    cache.put("c", entry())
+    assert cache.get("b") is None and cache.evictions == 1
+    assert cache.get("a") is not None
+
+    clock.now += 61
+    assert cache.get("a") is None and cache.expirations == 1
+    assert "a" not in cache.entries
+
+    disabled = OccurrenceCache(0, 60)
+    disabled.put("a", entry())
+    assert disabled.get("a") is None
+
+def test_occurrence_cache_invalidate_chat(clock):
+    cache = OccurrenceCache(10, 60)
+    for key in [(1, b"a"), (1, b"b"), (2, b"a")]:
+        cache.put(key, SimpleNamespace(cached_at=clock.now))
+    cache.invalidate_chat(1)
+    assert list(cache.entries) == [(2, b"a")]
+
+def flip_bits(signature, count, rng):
+    for bit in rng.sample(range(64), count):
+        signature ^= 1 << bit
+    return signature
+
+@pytest.mark.parametrize("max_distance", [0, 3, 6, 15])
+def test_hamming_index(max_distance):
+    # Banding guarantees every signature within max_distance bits is found
+    rng = random.Random(max_distance)
+    index = HammingIndex("phash", True, max_distance, 10000)
+    signatures = [rng.getrandbits(64) for _ in range(500)]
+    for key, signature in enumerate(signatures):
+        index.add(1, signature, key)
+    for key, signature in enumerate(signatures):
+        near = flip_bits(signature, rng.randint(0, max_distance), rng)
+        assert index.find(1, near)[0] == key
+        assert index.find(2, near) is None
+    # Nothing is ever matched outside max_distance
+    for signature in signatures:
+        far = flip_bits(signature, max_distance + 1, rng)
+        match = index.find(1, far)
+        assert match is None or (index.chats[1][0][match[0]] ^ far).bit_count() <= max_distance
+
+def test_hamming_index_eviction():
+    index = HammingIndex("phash", True, 6, 2)
+    for key in range(3):
+        index.add(1, key << 40, key)
+    entries, buckets = index.chats[1]
+    assert list(entries) == [1, 2]
+    assert all(0 not in bucket for bucket in buckets.values())
+    assert index.find(1, 2 << 40, exclude=2)[0] == 1
+    index.remove(1, 1)
+    index.remove(1, 2)
+    assert index.chats[1] == ({}, {})
+
+@pytest.mark.parametrize("signature", [0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1])
+def test_to_bigint(signature):
+    value = to_bigint(signature)
+    assert -(1 << 63) <= value < 1 << 63
+    assert HammingIndex("phash", True, 6, 1).load(value) == signature
+
+def sentences(words, count, rng):
+    vocabulary = [f"kata{i}" for i in range(5000)]
+    return [rng.sample(vocabulary, words) for _ in range(count)]
+
+@pytest.mark.parametrize("words, recall", [(5, 0.9), (10, 0.99)])
+def test_minhash_index(words, recall):
+    # One replaced word: 5-word messages keep a Jaccard similarity of 2/3
+    rng = random.Random(words)
+    index = MinHashIndex("minhash", True, 0.5, 10000)
+    originals = sentences(words, 300, rng)
+    for key, sentence in enumerate(originals):
+        index.add(1, minhash(" ".join(sentence)), key)
+    found = 0
+    for key, sentence in enumerate(originals):
+        edited = list(sentence)
+        edited[rng.randrange(words)] = "pengganti"
+        match = index.find(1, minhash(" ".join(edited)))
+        found += match is not None and match[0] == key
+        assert index.find(1, minhash(" ".join(sentence)), exclude=key) is None
+    assert found / len(originals) >= recall
+
+def test_minhash_index_unrelated():
+    rng = random.Random(0)
+    index = MinHashIndex("minhash", True, 0.5, 10000)
+    for key, sentence in enumerate(sentences(5, 300, rng)):
+        index.add(1, minhash(" ".join(sentence)), key)
+    matches = sum(index.find(1, minhash(" ".join(sentence))) is not None for sentence in sentences(5, 300, rng))
+    assert matches <= 3